@@ -1,19 +1,45 @@
 # python library to interface with panda
 from __future__ import print_function
 import binascii
+import collections
 import struct # https://www.npmjs.com/package/struct
 import hashlib
 import socket
+import sys
 import usb1 # https://github.com/vpelletier/python-libusb1 --> node.js https://github.com/tessel/node-usb
 import os
+import threading
 import time
 import traceback
 
-from dfu import PandaDFU
-from esptool import ESPROM, CesantaFlasher
-from flash_release import flash_release
-from update import ensure_st_up_to_date
-from serial import PandaSerial
+from .dfu import PandaDFU
+if sys.version_info[0] < 3:
+  # the flashing helpers are still python 2 sources, python 3 gets the rest
+  from .esptool import ESPROM, CesantaFlasher
+  from .flash_release import flash_release
+  from .update import ensure_st_up_to_date
+from .serial import PandaSerial
+from .columnar import CanColumns, parse_can_buffer_columnar, parse_can_buffer_tuples
+from .frames import CanFrame, CanFrameBatch
+from .receiver import CanReceiver
+from .adaptive import AdaptiveCanReader
+from .canfilter import CanFilter
+from .state import CanStateTable
+from .dbc import CanDatabase
+from .stats import CanStats
+from .retry import RetryPolicy, DetachedHandle, ReconnectingHandle, classify_usb_error, DISCONNECT, FATAL
+from .encoder import CanEncoder
+from .scheduler import CanScheduler
+from .flow import TxFlowControl
+from .txlanes import TxLanes
+from .recorder import CanRecorder, read_recording
+from .canlog import CanLogWriter, CanLogReader
+from .replay import CanReplay
+from .clock import CanClock, TimestampUnwrapper, monotonic
+from .shm import CanShmWriter, CanShmReader
+from .bufpool import BufferPool, PooledBuffer
+from .registry import DeviceRegistry, get_registry, PANDA_VID, PANDA_PIDS
+from .health import HealthSampler
 
 __version__ = '0.0.6'
 
@@ -180,33 +206,40 @@ def controlRead(
 # *** Canbus Parsing ***
 # **********************
 
-def parse_can_buffer(dat):
-  ret = []
-  for j in range(0, len(dat), 0x10): # 0x10 = 16
-    ddat = dat[j:j+0x10] # 0x10 = 16
-    # : is the delimiter of the slice syntax to 'slice out' sub-parts in sequences , [start:end]
-    # [1:5] is equivalent to "from 1 to 5" (5 not included)
-    # [1:] is equivalent to "1 to end"
-    # [len(a):] is equivalent to "from length of a to end"
-    # -------------------------
-    # struct.unpack - struct.unpack(format, string)
-    # Unpack the string (presumably packed by pack(fmt, ...)) according to the given format.
-    # The result is a tuple even if it contains exactly one item. The string must contain
-    # exactly the amount of data required by the format (len(string) must equal calcsize(fmt)).
-    f1, f2 = struct.unpack("II", ddat[0:8]) #
-    extended = 4
-    if f1 & extended:
-      address = f1 >> 3
-    else:
-      address = f1 >> 21
-    dddat = ddat[8:8+(f2&0xF)]
-    if DEBUG:
-      print("  R %x: %s" % (address, str(dddat).encode("hex")))
-    ret.append((address, f2>>16, dddat, (f2>>4)&0xFF))
+def parse_can_buffer(dat, can_filter=None):
+  if can_filter is not None:
+    # rejected frames are skipped before their payload is sliced
+    ret = can_filter.parse(dat)
+  else:
+    ret = parse_can_buffer_tuples(dat)
+  if DEBUG:
+    for address, _, dddat, _ in ret:
+      print("  R %x: %s" % (address, binascii.hexlify(dddat)))
   return ret
 
 
 
+def pack_can_frames(arr):
+  # [[addr, _, dat, bus], ...] -> list of 16 byte frame records for bulk endpoint 3
+  # reference implementation, Panda.can_send_many uses CanEncoder
+  snds = []
+  transmit = 1
+  extended = 4
+  for addr, _, dat, bus in arr:
+    assert len(dat) <= 8
+    if DEBUG:
+      print("  W %x: %s" % (addr, binascii.hexlify(dat)))
+    if addr >= 0x800:                                           # 0x800 = 2048
+      rir = (addr << 3) | transmit | extended
+    else:
+      rir = (addr << 21) | transmit
+    snd = struct.pack("II", rir, len(dat) | (bus << 4)) + dat
+    snd = snd.ljust(0x10, b'\x00')                              # 0x10 = 16
+    snds.append(snd)
+  return snds
+
+
+
 # *** normal mode ***
 
 class Panda(object):
@@ -232,52 +265,187 @@ class Panda(object):
   def __init__(self, serial=None, claim=True):
     self._serial = serial
     self._handle = None
+    self._receiver = None
+    self.can_filter = None
+    self.can_state = None
+    self.can_stats = CanStats()
+    self.retry_policy = RetryPolicy()
+    self._encoder = CanEncoder()
+    self._send_lock = threading.Lock()
+    self.tx_flow = None
+    self.tx_lanes = None
+    self.can_clock = None
+    self.buffer_pool = None
+    # last value of every setting, replayed after a reconnect
+    self._config = collections.OrderedDict()
+    self.auto_reconnect = False
+    self._generation = 0
+    self._reconnect_lock = threading.RLock()
+    self.reconnects = 0
+    self.last_outage = None
+    # answers that can't change while connected, cleared on connect
+    self._device_info = {}
+    self.health_sampler = None
     self.connect(claim)
 
   def close(self):
+    self.stop_can_receiver()
+    if self.health_sampler is not None:
+      self.health_sampler.stop()
+      self.health_sampler = None
+    if self.tx_lanes is not None:
+      dropped = self.tx_lanes.stop()
+      if dropped:
+        print("CAN: TX LANES DROPPED %d FRAMES ON CLOSE" % dropped)
+      self.tx_lanes = None
+    if self.buffer_pool is not None:
+      self.buffer_pool.close()
     self._handle.close()
     self._handle = None
 
+  @staticmethod
+  def list():
+    # serials of the connected pandas, from the hotplug driven device cache
+    ret = []
+    try:
+      ret = [device.serial for device in get_registry().find(PANDA_VID, PANDA_PIDS)]
+    except Exception:
+      pass
+    # TODO: detect if this is real
+    #ret += ["WIFI"]
+    return ret
 
   def connect(self, claim=True, wait=False):
-    if self._handle != None:
+    if not self._detached():
       self.close()
+    self._claim = claim
 
     if self._serial == "WIFI":
       self._handle = WifiHandle()
       print("opening WIFI device")
       self.wifi = True
     else:
-      context = usb1.USBContext()
-      self._handle = None
+      registry = get_registry()
+      self._context = registry.context
       self.wifi = False
 
       while 1:
         try:
-          for device in context.getDeviceList(skip_on_error=True):
-            #print(device)
-            if device.getVendorID() == 0xbbaa and device.getProductID() in [0xddcc, 0xddee]: # 0xbbaa = 48042 | 0xddcc = 56780 | 0xddee = 56814
-              try:
-                this_serial = device.getSerialNumber()
-              except Exception:
-                continue
-              if self._serial is None or this_serial == self._serial:
-                self._serial = this_serial
-                print("opening device", self._serial, hex(device.getProductID()))
-                self.bootstub = device.getProductID() == 0xddee # 0xddee = 56814
-                self.legacy = (device.getbcdDevice() != 0x2300) # 0x2300 = 8960
-                self._handle = device.open()
-                if claim:
-                  self._handle.claimInterface(0)
-                  #self._handle.setInterfaceAltSetting(0, 0) #Issue in USB stack
-                break
+          for device in registry.find(PANDA_VID, PANDA_PIDS, self._serial):
+            self._serial = device.serial
+            print("opening device", self._serial, hex(device.pid))
+            self.bootstub = device.pid == 0xddee # 0xddee = 56814
+            self.legacy = (device.bcd != 0x2300) # 0x2300 = 8960
+            try:
+              handle = device.device.open()
+            except usb1.USBError as e:
+              if classify_usb_error(e) != DISCONNECT:
+                raise
+              # unplugged before hotplug told us, wait for it to come back
+              registry.forget(device)
+              continue
+            if claim:
+              handle.claimInterface(0)
+              #handle.setInterfaceAltSetting(0, 0) #Issue in USB stack
+            self._handle = handle
+            break
+        except usb1.USBError as e:
+          # permission / busy errors won't go away by rescanning
+          if classify_usb_error(e) == FATAL:
+            raise
+          print("exception", e)
+          traceback.print_exc()
         except Exception as e:
           print("exception", e)
           traceback.print_exc()
-        if wait == False or self._handle != None:
+        if wait == False or not self._detached():
           break
-    assert(self._handle != None)
+        # woken by hotplug as soon as the device shows up
+        registry.wait_for(PANDA_VID, PANDA_PIDS, self._serial, timeout=1.0)
+    if self._detached():
+      raise usb1.USBErrorNoDevice()
     print("connected")
+    self._device_info = {}
+    self._generation += 1
+    if self.auto_reconnect and not self.wifi:
+      self._handle = ReconnectingHandle(self, self._handle, self._generation)
+    if self.can_clock is not None:
+      # the device may have reset, old timer readings mean nothing now
+      self.can_clock.reset()
+
+  def _detached(self):
+    # no usable handle, never connected or in the middle of a reconnect
+    return isinstance(getattr(self._handle, "handle", self._handle), (type(None), DetachedHandle))
+
+  def reconnect(self, generation=None):
+    """Reopens the same serial after the handle was lost and replays the config.
+
+    Receivers and other users of the panda keep running: their transfers
+    wait for the reconnect and continue on the new handle, or raise
+    USBErrorNoDevice if it timed out. If generation is given and another
+    thread already replaced that handle, returns at once.
+    """
+    with self._reconnect_lock:
+      if generation is not None and generation != self._generation:
+        return
+      start = monotonic()
+      try:
+        self._handle.close()
+      except Exception:
+        pass
+      self._handle = DetachedHandle(self)
+      if self.auto_reconnect:
+        self._handle = ReconnectingHandle(self, self._handle, self._generation)
+      end = start + self.retry_policy.reconnect_timeout
+      while True:
+        if not self.wifi:
+          # returns as soon as hotplug reports the serial again
+          get_registry().wait_for(PANDA_VID, PANDA_PIDS, self._serial, timeout=max(end - monotonic(), 0))
+        try:
+          self.connect(self._claim)
+          break
+        except usb1.USBError:
+          if monotonic() > end:
+            raise
+          time.sleep(0.01)
+      for name, args in list(self._config.values()):
+        getattr(self, name)(*args)
+      self.reconnects += 1
+      self.last_outage = monotonic() - start
+      print("reconnected to %s after %.3f s" % (self._serial, self.last_outage))
+
+  def enable_auto_reconnect(self, timeout=5.0):
+    """Survives resets and cable glitches, see reconnect.
+
+    Any transfer that finds the device gone waits for it to come back
+    (for up to timeout seconds), replays the settings made through the
+    set_* methods and is retried on the new handle.
+    """
+    self.auto_reconnect = True
+    self.retry_policy.on_exhausted = RetryPolicy.RECONNECT
+    self.retry_policy.reconnect_timeout = timeout
+    if not self.wifi and not isinstance(self._handle, ReconnectingHandle):
+      self._handle = ReconnectingHandle(self, self._handle, self._generation)
+
+  def _remember(self, key, name, *args):
+    self._config[key] = (name, args)
+
+  def _usb_retry(self, msg, counter, fn, *args):
+    # runs a bulk transfer under self.retry_policy, see retry.py
+    # counter names the can_stats field counting its retries
+    retry = self.retry_policy.tracker(self.can_stats, counter, msg)
+    while True:
+      generation = self._generation
+      try:
+        return fn(*args)
+      except usb1.USBError as e:
+        action = retry.failed(e)
+        if action == RetryPolicy.RAISE:
+          raise
+        if action == RetryPolicy.RECONNECT:
+          self.reconnect(generation)
+        else:
+          time.sleep(retry.delay())
 
 
   def call_control_api(self, msg):
@@ -285,9 +453,12 @@ class Panda(object):
 
   # ******************* health *******************
 
-  def health(self):
+  def _health_raw(self):
     dat = self._handle.controlRead(Panda.REQUEST_IN, 0xd2, 0, 0, 13) # 0xd2 = 210
-    a = struct.unpack("IIBBBBB", dat)
+    return struct.unpack("IIBBBBB", dat)
+
+  def health(self):
+    a = self._health_raw()
     return {"voltage": a[0], "current": a[1],
             "started": a[2], "controls_allowed": a[3],
             "gas_interceptor_detected": a[4],
@@ -297,27 +468,48 @@ class Panda(object):
   # ******************* control *******************
 
   def enter_bootloader(self):
+    # the device leaves on purpose, don't let auto reconnect chase it
+    handle = getattr(self._handle, "handle", self._handle)
+    self._device_info = {}
     try:
-      self._handle.controlWrite(Panda.REQUEST_OUT, 0xd1, 0, 0, b'') # 0xd1 = 209
+      handle.controlWrite(Panda.REQUEST_OUT, 0xd1, 0, 0, b'') # 0xd1 = 209
     except Exception as e:
       print(e)
       pass
 
+  def _cached(self, key, fn):
+    # fn() once per connection, see refresh_device_info
+    try:
+      return self._device_info[key]
+    except KeyError:
+      ret = self._device_info[key] = fn()
+      return ret
+
+  def refresh_device_info(self):
+    """Forgets cached version, serial, secret and grey answers."""
+    self._device_info = {}
+
   def get_version(self):
-    return self._handle.controlRead(Panda.REQUEST_IN, 0xd6, 0, 0, 0x40) # 0xd6 = 214 | 0x40 = 64
+    # a copy, the cached bytearray is shared by every caller
+    return self._cached("version", lambda: self._handle.controlRead(Panda.REQUEST_IN, 0xd6, 0, 0, 0x40))[:] # 0xd6 = 214 | 0x40 = 64
 
   def is_grey(self):
-    ret = self._handle.controlRead(Panda.REQUEST_IN, 0xc1, 0, 0, 0x40) # 0xc1 = 193 | 0x40 = 64
+    ret = self._cached("grey", lambda: self._handle.controlRead(Panda.REQUEST_IN, 0xc1, 0, 0, 0x40)) # 0xc1 = 193 | 0x40 = 64
     return ret == "\x01"
 
-  def get_serial(self):
+  def _read_serial(self):
     dat = self._handle.controlRead(Panda.REQUEST_IN, 0xd0, 0, 0, 0x20) # 0xd0 = 208 | 0x20 = 32
     hashsig, calc_hash = dat[0x1c:], hashlib.sha1(dat[0:0x1c]).digest()[0:4] # 0x1c = 28
     assert(hashsig == calc_hash)
     return [dat[0:0x10], dat[0x10:0x10+10]] # 0x10 = 16
 
+  def get_serial(self):
+    # verified once per connection, callers get their own list
+    return list(self._cached("serial", self._read_serial))
+
   def get_secret(self):
-    return self._handle.controlRead(Panda.REQUEST_IN, 0xd0, 1, 0, 0x10) # 0xd0 = 208 | 0x10 = 16
+    # a copy, like get_version
+    return self._cached("secret", lambda: self._handle.controlRead(Panda.REQUEST_IN, 0xd0, 1, 0, 0x10))[:] # 0xd0 = 208 | 0x10 = 16
 
   # ******************* configuration *******************
 
@@ -333,77 +525,202 @@ class Panda(object):
 
   def set_safety_mode(self, mode=SAFETY_NOOUTPUT):
     self._handle.controlWrite(Panda.REQUEST_OUT, 0xdc, mode, 0, b'') # 0xdc = 220
+    self._remember("safety_mode", "set_safety_mode", mode)
 
   def set_can_forwarding(self, from_bus, to_bus):
     # TODO: This feature may not work correctly with saturated buses
     self._handle.controlWrite(Panda.REQUEST_OUT, 0xdd, from_bus, to_bus, b'') # 0xdd = 221
+    self._remember(("can_forwarding", from_bus), "set_can_forwarding", from_bus, to_bus)
 
   def set_gmlan(self, bus=2):
     if bus is None:
       self._handle.controlWrite(Panda.REQUEST_OUT, 0xdb, 0, 0, b'') # 0xdb = 219
     elif bus in [Panda.GMLAN_CAN2, Panda.GMLAN_CAN3]:
       self._handle.controlWrite(Panda.REQUEST_OUT, 0xdb, 1, bus, b'') # 0xdb = 219
+    self._remember("gmlan", "set_gmlan", bus)
 
   def set_can_loopback(self, enable):
     # set can loopback mode for all buses
     self._handle.controlWrite(Panda.REQUEST_OUT, 0xe5, int(enable), 0, b'') # 0xe5 = 229
+    self._remember("can_loopback", "set_can_loopback", enable)
 
   def set_can_speed_kbps(self, bus, speed):
     self._handle.controlWrite(Panda.REQUEST_OUT, 0xde, bus, int(speed*10), b'') # 0xde = 222
+    self.can_stats.set_speed(bus, speed)
+    self._remember(("can_speed", bus), "set_can_speed_kbps", bus, speed)
 
   def set_uart_baud(self, uart, rate):
     self._handle.controlWrite(Panda.REQUEST_OUT, 0xe4, uart, rate/300, b'') # 0xe4 = 229
+    self._remember(("uart_baud", uart), "set_uart_baud", uart, rate)
 
   def set_uart_parity(self, uart, parity):
     # parity, 0=off, 1=even, 2=odd
     self._handle.controlWrite(Panda.REQUEST_OUT, 0xe2, uart, parity, b'') # 0xe2 = 226
+    self._remember(("uart_parity", uart), "set_uart_parity", uart, parity)
 
   def set_uart_callback(self, uart, install):
     self._handle.controlWrite(Panda.REQUEST_OUT, 0xe3, uart, int(install), b'') # 0xe3 = 227
+    self._remember(("uart_callback", uart), "set_uart_callback", uart, install)
 
 
   # ******************* can *******************
 
   def can_send_many(self, arr):
-    snds = []
-    transmit = 1
-    extended = 4
-    for addr, _, dat, bus in arr:
-      assert len(dat) <= 8
-      if DEBUG:
-        print("  W %x: %s" % (addr, dat.encode("hex")))
-      if addr >= 0x800:                                           # 0x800 = 2048
-        rir = (addr << 3) | transmit | extended
-      else:
-        rir = (addr << 21) | transmit
-      snd = struct.pack("II", rir, len(dat) | (bus << 4)) + dat
-      snd = snd.ljust(0x10, b'\x00')                              # 0x10 = 16
-      snds.append(snd)
+    if self.tx_flow is not None:
+      self.tx_flow.send(arr)
+    else:
+      self._can_send_many(arr)
 
-    while True:
-      try:
-        #print("DAT: %s"%b''.join(snds).__repr__())
-        if self.wifi:
-          for s in snds:
-            self._handle.bulkWrite(3, s)
-        else:
-          self._handle.bulkWrite(3, b''.join(snds))
-        break
-      except (usb1.USBErrorIO, usb1.USBErrorOverflow):
-        print("CAN: BAD SEND MANY, RETRYING")
+  def enable_tx_flow_control(self, queue_depth=0xC0, max_transfer=0x100, min_transfer=0x10):
+    """Routes can_send_many through per bus token buckets, see flow.py.
+
+    Large batches are split into transfers the firmware TX queues can
+    absorb at the bitrates set with set_can_speed_kbps.
+    """
+    if self.tx_flow is None:
+      self.tx_flow = TxFlowControl(self, queue_depth, max_transfer, min_transfer)
+    return self.tx_flow
+
+  def enable_tx_lanes(self, n_lanes=3, max_transfer=0x40):
+    """Starts a TxLanes sender, submit() frames to it with a priority.
+
+    Lane 0 always goes into the next bulk write, lower lanes fill what is
+    left of its max_transfer frames.
+    """
+    if self.tx_lanes is None:
+      self.tx_lanes = TxLanes(self, n_lanes, max_transfer).start()
+    return self.tx_lanes
+
+  def _can_send_many(self, arr):
+    if DEBUG:
+      for addr, _, dat, bus in arr:
+        print("  W %x: %s" % (addr, binascii.hexlify(dat)))
+    with self._send_lock:
+      # the encoder buffer is reused, so encode, write and count under the lock
+      dat = self._encoder.encode(arr)
+      self._can_write(dat)
+      self.can_stats.record_tx(dat)
+
+  def can_send_arrays(self, addresses, buses, data, lengths=None):
+    """can_send_many for numpy arrays, see CanEncoder.encode_arrays."""
+    if self.tx_flow is not None:
+      self.tx_flow.send_arrays(addresses, buses, data, lengths)
+    else:
+      self._can_send_arrays(addresses, buses, data, lengths)
+
+  def _can_send_arrays(self, addresses, buses, data, lengths=None):
+    with self._send_lock:
+      dat = self._encoder.encode_arrays(addresses, buses, data, lengths)
+      self._can_write(dat)
+      self.can_stats.record_tx(dat)
+
+  def _can_write(self, dat):
+    if self.wifi:
+      for i in range(0, len(dat), 0x10):
+        self._usb_retry("CAN: BAD SEND MANY", "send_retries", self._send_bulk, dat[i:i+0x10])
+    else:
+      self._usb_retry("CAN: BAD SEND MANY", "send_retries", self._send_bulk, dat)
 
   def can_send(self, addr, dat, bus):
     self.can_send_many([[addr, None, dat, bus]])
 
+  # go through self._handle on every call so retries pick up a reconnect
+  def _send_bulk(self, dat):
+    return self._handle.bulkWrite(3, dat)
+
+  def _recv_bulk(self, length):
+    return self._handle.bulkRead(1, length)
+
+  def _can_read(self, length=0x10*256): # 0x10 is 16, (16*256=4096)
+    dat = self._usb_retry("CAN: BAD RECV", "recv_retries", self._recv_bulk, length)
+    self.can_stats.record_rx(dat)
+    return dat
+
+  def _on_read(self, batch):
+    """Feeds can_clock and can_state with one bulk read.
+
+    Every receive path calls this once per read, in read order, before
+    handing the frames out. Sets batch.host_t and batch.err when the clock
+    is on and returns the parsed CanColumns, or None when neither is on.
+    """
+    clock, state = self.can_clock, self.can_state
+    if clock is None and state is None:
+      return None
+    cols = parse_can_buffer_columnar(batch.buffer)
+    if clock is not None:
+      batch.host_t, batch.err = clock.annotate(cols, batch.t)
+    if state is not None:
+      # every frame read, can_filter only applies to what can_recv returns
+      state.update_columns(cols, batch.t)
+    return cols
+
   def can_recv(self):
-    dat = bytearray()
-    while True:
-      try:
-        dat = self._handle.bulkRead(1, 0x10*256) # 0x10 is 16, (16*256=4096)
-        break
-      except (usb1.USBErrorIO, usb1.USBErrorOverflow):
-        print("CAN: BAD RECV, RETRYING")
-    return parse_can_buffer(dat)
+    dat = self._can_read()
+    self._on_read(CanFrameBatch(dat, monotonic()))
+    return parse_can_buffer(dat, self.can_filter)
+
+  def can_recv_batch(self):
+    # like can_recv, but frames are lazy views over the read buffer
+    batch = CanFrameBatch(self._can_read(), monotonic())
+    self._on_read(batch)
+    return batch
+
+  def enable_buffer_pool(self, n_buffers=8, transfers=2):
+    """Receive path into preallocated buffers, see BufferPool.read."""
+    if self.buffer_pool is None:
+      self.buffer_pool = BufferPool(self, n_buffers, transfers=transfers)
+    return self.buffer_pool
+
+  def enable_can_clock(self, tick_hz=1000000):
+    """Maps device bus_time onto time.monotonic, see clock.py."""
+    if self.can_clock is None:
+      self.can_clock = CanClock(tick_hz)
+    return self.can_clock
+
+  def can_recv_timed(self):
+    """Returns (CanColumns, host times, error estimates) for one read.
+
+    Turns the clock on; every receive path feeds it from then on.
+    """
+    self.enable_can_clock()
+    batch = CanFrameBatch(self._can_read(), monotonic())
+    cols = self._on_read(batch)
+    return cols, batch.host_t, batch.err
+
+  def start_can_receiver(self, capacity=1024):
+    """Starts continuous bulk reads in a background thread.
+
+    Args:
+      capacity (int): number of read batches buffered before the oldest
+        is dropped (and counted).
+
+    Returns:
+      CanReceiver: drain() / wait() it instead of calling can_recv.
+    """
+    if self._receiver is None:
+      self._receiver = CanReceiver(self, capacity)
+      self._receiver.start()
+    return self._receiver
+
+  def enable_can_state(self, capacity=1024):
+    """Keeps a CanStateTable of the latest frame per (bus, address).
+
+    It is fed by every receive path, see _on_read.
+    """
+    if self.can_state is None:
+      self.can_state = CanStateTable(capacity)
+    return self.can_state
+
+  def start_health_sampler(self, rate_hz=10., history=600):
+    """Polls health() from one background thread, see HealthSampler."""
+    if self.health_sampler is None:
+      self.health_sampler = HealthSampler(self, rate_hz, history).start()
+    return self.health_sampler
+
+  def stop_can_receiver(self):
+    if self._receiver is not None:
+      self._receiver.stop()
+      self._receiver = None
 
   def can_clear(self, bus):
     """Clears all messages from the specified internal CAN ringbuffer as
@@ -672,20 +989,3 @@ class Panda(object):
 #   ret = os.system("cd %s && make clean && make ota" % (os.path.join(BASEDIR, "boardesp")))
 #   time.sleep(1)
 #   return ret==0
-#
-# @staticmethod
-# def list():
-#   context = usb1.USBContext()
-#   ret = []
-#   try:
-#     for device in context.getDeviceList(skip_on_error=True):
-#       if device.getVendorID() == 0xbbaa and device.getProductID() in [0xddcc, 0xddee]:
-#         try:
-#           ret.append(device.getSerialNumber())
-#         except Exception:
-#           continue
-#   except Exception:
-#     pass
-#   # TODO: detect if this is real
-#   #ret += ["WIFI"]
-#   return ret
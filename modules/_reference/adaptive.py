@@ -0,0 +1,85 @@
+# can_recv with the bulk read size and poll interval tuned from observed fill
+import time
+
+from .clock import monotonic
+from .frames import CanFrameBatch
+
+# reads must be a multiple of the 64 byte max packet size or libusb overflows
+MIN_READ_SIZE = 0x40 # 4 frames
+MAX_READ_SIZE = 0x10*256 # 256 frames
+
+
+class AdaptiveCanReader(object):
+  """Picks the request size and polling interval for each bulk read.
+
+  target="latency": poll at most every `latency_interval` and shrink reads
+    while they come back mostly empty, so frames are picked up quickly.
+  target="throughput": back off the poll interval (up to `max_interval`)
+    while reads are mostly empty and grow reads while they come back full,
+    so each round trip carries as many frames as possible.
+
+  The current choice is in read_size / poll_interval, fill is a moving
+  average of bytes returned / bytes requested.
+  """
+
+  LATENCY = "latency"
+  THROUGHPUT = "throughput"
+
+  def __init__(self, panda, target=LATENCY, latency_interval=0.001, max_interval=0.02, alpha=0.2):
+    assert target in (self.LATENCY, self.THROUGHPUT)
+    self.panda = panda
+    self.target = target
+    self.latency_interval = latency_interval
+    self.max_interval = max_interval
+    self.alpha = alpha
+
+    self.read_size = MAX_READ_SIZE
+    self.poll_interval = 0.0
+    self.fill = 0.0
+    self._next_poll = 0.0
+
+  def params(self):
+    return {"target": self.target, "read_size": self.read_size,
+            "poll_interval": self.poll_interval, "fill": self.fill}
+
+  def _tune(self, n):
+    fill = float(n) / self.read_size
+    self.fill += self.alpha * (fill - self.fill)
+
+    if fill >= 1.0:
+      # the device had more queued than we asked for, read more and sooner
+      self.read_size = min(self.read_size * 2, MAX_READ_SIZE)
+      self.poll_interval /= 2
+    elif self.target == self.LATENCY:
+      self.poll_interval = min(self.poll_interval * 1.5 + 0.0001, self.latency_interval)
+      if self.fill < 0.25:
+        self.read_size = max(self.read_size // 2, MIN_READ_SIZE)
+    elif self.fill < 0.5:
+      self.poll_interval = min(self.poll_interval * 1.5 + 0.0005, self.max_interval)
+    elif self.fill > 0.9:
+      self.read_size = min(self.read_size * 2, MAX_READ_SIZE)
+      self.poll_interval *= 0.75
+
+  def _read(self):
+    # waits out the poll interval, reads and feeds the panda's post-read hook
+    delay = self._next_poll - monotonic()
+    if delay > 0:
+      time.sleep(delay)
+    dat = self.panda._can_read(self.read_size)
+    batch = CanFrameBatch(dat, monotonic())
+    self.panda._on_read(batch)
+    self._tune(len(dat))
+    self._next_poll = monotonic() + self.poll_interval
+    return dat, batch
+
+  def read(self):
+    # raw bulk read, waiting out the poll interval first
+    return self._read()[0]
+
+  def recv(self):
+    # like Panda.can_recv, can_filter included; the package imports this module first
+    from . import parse_can_buffer
+    return parse_can_buffer(self.read(), self.panda.can_filter)
+
+  def recv_batch(self):
+    return self._read()[1]
@@ -0,0 +1,356 @@
+# asyncio interface to panda on top of libusb asynchronous transfers (python 3)
+import asyncio
+import binascii
+import struct
+
+import usb1
+
+from . import Panda, DEBUG
+from .clock import monotonic
+from .encoder import CanEncoder
+from .frames import CanFrameBatch
+from .registry import CAN_IN_ENDPOINT, CAN_OUT_ENDPOINT, get_registry
+from .retry import RetryPolicy, transfer_error
+
+
+class AsyncPanda(object):
+  """Panda driven from an asyncio event loop.
+
+  libusb's poll fds are registered with the loop, so completions are handled
+  on the loop thread without a helper thread per call. can_stream() keeps
+  `transfers` bulk-IN transfers queued on endpoint 1 at all times, and
+  follows reconnects of the panda, whoever makes them. The loop is the one
+  running the first call, unless one is passed in.
+
+    panda = AsyncPanda(serial)
+    async for batch in panda.can_stream():
+      ...
+  """
+
+  def __init__(self, serial=None, claim=True, transfers=4, queue_size=256, idle_sleep=0.001, loop=None):
+    self.panda = Panda(serial, claim)
+    if self.panda.wifi:
+      raise Exception("AsyncPanda needs a USB connected panda")
+    self._context = self.panda._context
+    self._loop = loop
+    self._watching = False
+    self.n_transfers = transfers
+    self.queue_size = queue_size
+    self.idle_sleep = idle_sleep
+    # not the panda's, whose buffer a sync sender may be writing from
+    self._encoder = CanEncoder()
+
+    # bulk-IN transfers of the handle from generation _in_generation
+    self._in_transfers = []
+    self._in_generation = None
+    self._in_flight = set()
+    # stream transfers _stop_stream cancelled, their completion is ours
+    self._cancelled = set()
+    self._queue = None
+    self._streaming = False
+    # waiting for the reconnect that took the stream's handle away
+    self._recovering = False
+    self._timer = None
+    # RetryState of the current run of failed stream reads
+    self._recv_retry = None
+
+    self.overflows = 0
+    self.dropped_frames = 0
+    self.transfer_errors = 0
+
+  # ******************* event loop integration *******************
+
+  def _attach(self):
+    # called from the loop, on the first transfer
+    if self._loop is None:
+      self._loop = asyncio.get_running_loop()
+    if not self._watching:
+      # the registry owns the context's fd notifiers, shared by every AsyncPanda
+      get_registry().watch_pollfds(self._loop)
+      self._watching = True
+
+  def _handle_events(self):
+    self._context.handleEventsTimeout(0)
+    self._schedule_timeout()
+
+  def _schedule_timeout(self):
+    # libusb internal timeouts are not signalled through the fds
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+    timeout = self._context.getNextTimeout()
+    if timeout is not None:
+      self._timer = self._loop.call_later(timeout, self._handle_events)
+
+  def _on_loop(self, fn):
+    # the shared context's event thread can complete our transfers too
+    return lambda transfer: self._loop.call_soon_threadsafe(fn, transfer)
+
+  def _submit(self, transfer):
+    transfer.submit()
+    self._in_flight.add(transfer)
+    self._schedule_timeout()
+
+  def _transfer(self, setup, *args):
+    # one-shot transfer completing a future on the loop thread
+    self._attach()
+    fut = self._loop.create_future()
+    # the current handle, a reconnect replaces it
+    transfer = self.panda._handle.getTransfer()
+
+    def done(t):
+      self._in_flight.discard(t)
+      if fut.done():
+        return
+      status = t.getStatus()
+      if status == usb1.TRANSFER_COMPLETED:
+        fut.set_result(bytes(t.getBuffer()[:t.getActualLength()]))
+      else:
+        fut.set_exception(transfer_error(status))
+
+    getattr(transfer, setup)(*args, callback=self._on_loop(done))
+    self._submit(transfer)
+    return fut
+
+  async def _retry(self, counter, msg, setup, *args):
+    # _transfer under the panda's RetryPolicy, the rules of Panda._usb_retry
+    retry = self.panda.retry_policy.tracker(self.panda.can_stats, counter, msg)
+    while True:
+      generation = self.panda._generation
+      try:
+        return await self._transfer(setup, *args)
+      except usb1.USBError as e:
+        action = retry.failed(e)
+        if action == RetryPolicy.RAISE:
+          raise
+        if action == RetryPolicy.RECONNECT:
+          await self._reconnect(generation)
+        else:
+          await asyncio.sleep(retry.delay())
+
+  # ******************* control *******************
+
+  def control_read(self, request, value, index, length):
+    return self._retry("control_retries", "CONTROL: BAD READ", "setControl",
+                       Panda.REQUEST_IN, request, value, index, length)
+
+  def control_write(self, request, value, index, data=b''):
+    return self._retry("control_retries", "CONTROL: BAD WRITE", "setControl",
+                       Panda.REQUEST_OUT, request, value, index, data)
+
+  async def health(self):
+    dat = await self.control_read(0xd2, 0, 0, 13) # 0xd2 = 210
+    a = struct.unpack("IIBBBBB", dat)
+    return {"voltage": a[0], "current": a[1],
+            "started": a[2], "controls_allowed": a[3],
+            "gas_interceptor_detected": a[4],
+            "started_signal_detected": a[5],
+            "started_alt": a[6]}
+
+  def get_version(self):
+    return self.control_read(0xd6, 0, 0, 0x40) # 0xd6 = 214 | 0x40 = 64
+
+  # the setters keep the panda's bookkeeping, so reconnects replay them
+
+  async def set_safety_mode(self, mode=Panda.SAFETY_NOOUTPUT):
+    await self.control_write(0xdc, mode, 0) # 0xdc = 220
+    self.panda._remember("safety_mode", "set_safety_mode", mode)
+
+  async def set_can_forwarding(self, from_bus, to_bus):
+    await self.control_write(0xdd, from_bus, to_bus) # 0xdd = 221
+    self.panda._remember(("can_forwarding", from_bus), "set_can_forwarding", from_bus, to_bus)
+
+  async def set_can_loopback(self, enable):
+    await self.control_write(0xe5, int(enable), 0) # 0xe5 = 229
+    self.panda._remember("can_loopback", "set_can_loopback", enable)
+
+  async def set_can_speed_kbps(self, bus, speed):
+    await self.control_write(0xde, bus, int(speed*10)) # 0xde = 222
+    self.panda.can_stats.set_speed(bus, speed)
+    self.panda._remember(("can_speed", bus), "set_can_speed_kbps", bus, speed)
+
+  def can_clear(self, bus):
+    return self.control_write(0xf1, bus, 0) # 0xf1 = 241
+
+  # ******************* can *******************
+
+  def _reconnect(self, generation):
+    # Panda.reconnect blocks, so it runs off the loop, the transfers it
+    # cancels still complete on the loop through _on_loop
+    return self._loop.run_in_executor(None, self.panda.reconnect, generation)
+
+  async def can_send_many(self, arr):
+    if DEBUG:
+      for addr, _, dat, bus in arr:
+        print("  W %x: %s" % (addr, binascii.hexlify(dat)))
+    # a copy, the transfer holds on to it while other sends encode
+    dat = bytes(self._encoder.encode(arr))
+    ret = await self._retry("send_retries", "CAN: BAD SEND MANY", "setBulk", CAN_OUT_ENDPOINT, dat)
+    self.panda.can_stats.record_tx(dat)
+    return ret
+
+  def can_send(self, addr, dat, bus):
+    return self.can_send_many([[addr, None, dat, bus]])
+
+  def _start_stream(self):
+    if self._streaming:
+      return
+    self._attach()
+    self._streaming = True
+    self._recv_retry = None
+    self._queue = asyncio.Queue()
+    self._submit_stream()
+
+  def _submit_stream(self):
+    # transfers belong to a handle, so make new ones after a reconnect
+    if self._in_generation != self.panda._generation:
+      self._in_transfers = []
+    if not self._in_transfers:
+      handle = self.panda._handle
+      for _ in range(self.n_transfers):
+        transfer = handle.getTransfer()
+        transfer.setBulk(CAN_IN_ENDPOINT, 0x10*256, callback=self._on_loop(self._on_can_in)) # 0x10 is 16, (16*256=4096)
+        self._in_transfers.append(transfer)
+      self._in_generation = self.panda._generation
+    for transfer in self._in_transfers:
+      if not transfer.isSubmitted():
+        self._submit(transfer)
+
+  def _resubmit(self, transfer):
+    if self._streaming and not transfer.isSubmitted():
+      self._submit(transfer)
+
+  def _on_can_in(self, transfer):
+    self._in_flight.discard(transfer)
+    status = transfer.getStatus()
+    if not self._streaming or transfer not in self._in_transfers:
+      # stopped, or a late completion of a transfer replaced after a reconnect
+      self._cancelled.discard(transfer)
+      return
+    if transfer in self._cancelled:
+      self._cancelled.discard(transfer)
+      if status == usb1.TRANSFER_CANCELLED:
+        # stopped and started again before the cancellation came back
+        self._resubmit(transfer)
+        return
+    if status == usb1.TRANSFER_CANCELLED:
+      # not by us, so the handle was closed, most likely by a reconnect made
+      # elsewhere (Panda.reconnect, auto reconnect, a BufferPool)
+      self._recover(False)
+      return
+    if status != usb1.TRANSFER_COMPLETED:
+      self._recv_failed(transfer, transfer_error(status))
+      return
+    self._recv_retry = None
+    dat = bytes(transfer.getBuffer()[:transfer.getActualLength()])
+    self.panda.can_stats.record_rx(dat)
+    if len(dat) == 0:
+      # nothing buffered on the device, back off instead of spinning
+      self._loop.call_later(self.idle_sleep, self._resubmit, transfer)
+      return
+    batch = CanFrameBatch(dat, monotonic())
+    self.panda._on_read(batch)
+    self._put(batch)
+    self._resubmit(transfer)
+
+  def _recv_failed(self, transfer, e):
+    # the rules of Panda._usb_retry, see RetryState
+    self.transfer_errors += 1
+    if self._recovering:
+      # the other transfers of a handle that is being replaced
+      self.panda.can_stats.record_error(e)
+      return
+    if self._recv_retry is None:
+      self._recv_retry = self.panda.retry_policy.tracker(self.panda.can_stats, "recv_retries",
+                                                         "CAN: BAD RECV")
+    action = self._recv_retry.failed(e)
+    if action == RetryPolicy.RETRY:
+      self._loop.call_later(self._recv_retry.delay(), self._resubmit, transfer)
+    elif action == RetryPolicy.RECONNECT:
+      self._recover(True)
+    else:
+      self._end_stream(e)
+
+  def _recover(self, reconnect):
+    # the stream's handle is gone, reconnect (or wait for the reconnect in
+    # progress elsewhere) and carry on with transfers on the new handle
+    if not self._recovering:
+      self._recovering = True
+      self._loop.create_task(self._resume_stream(self._in_generation, reconnect))
+
+  def _wait_reconnect(self):
+    # Panda.reconnect holds the lock until the new handle is set up
+    with self.panda._reconnect_lock:
+      pass
+
+  async def _resume_stream(self, generation, reconnect):
+    try:
+      if reconnect:
+        await self._reconnect(generation)
+      else:
+        await self._loop.run_in_executor(None, self._wait_reconnect)
+      if not self._streaming:
+        return
+      if self.panda._generation == generation:
+        # closed without a reconnect, or the reconnect gave up
+        raise usb1.USBErrorNoDevice()
+      self._submit_stream()
+    except Exception as e:
+      self._end_stream(e)
+    finally:
+      self._recovering = False
+
+  def _end_stream(self, e):
+    # can_stream() raises e once the batches before it are consumed
+    if self._streaming:
+      self._streaming = False
+      self._queue.put_nowait(e)
+
+  def _put(self, batch):
+    if self._queue.qsize() >= self.queue_size:
+      old = self._queue.get_nowait()
+      self.overflows += 1
+      self.dropped_frames += len(old)
+    self._queue.put_nowait(batch)
+
+  def _stop_stream(self):
+    self._streaming = False
+    for transfer in self._in_transfers:
+      if transfer.isSubmitted():
+        try:
+          transfer.cancel()
+          self._cancelled.add(transfer)
+        except usb1.USBErrorNotFound:
+          pass
+
+  async def can_stream(self):
+    """Yields a CanFrameBatch per completed bulk read."""
+    self._start_stream()
+    try:
+      while True:
+        item = await self._queue.get()
+        if isinstance(item, Exception):
+          raise item
+        yield item
+    finally:
+      self._stop_stream()
+
+  async def close(self):
+    self._stop_stream()
+    for transfer in list(self._in_flight):
+      if transfer.isSubmitted():
+        try:
+          transfer.cancel()
+        except usb1.USBErrorNotFound:
+          pass
+    # let the cancellations complete before the handle goes away
+    while any(t.isSubmitted() for t in self._in_transfers) or self._in_flight:
+      self._handle_events()
+      await asyncio.sleep(0.001)
+    if self._timer is not None:
+      self._timer.cancel()
+    if self._watching:
+      get_registry().unwatch_pollfds(self._loop)
+      self._watching = False
+    self.panda.close()
+
@@ -0,0 +1,272 @@
+# CAN receive path into a fixed pool of preallocated buffers
+import collections
+import threading
+import time
+
+import usb1
+
+from .clock import monotonic
+from .columnar import parse_can_buffer_columnar
+from .frames import CanFrameBatch
+from .registry import CAN_IN_ENDPOINT
+from .retry import RetryPolicy, transfer_error
+
+# seconds to wait for cancelled reads to hand their buffers back
+DRAIN_TIMEOUT = 1.0
+
+
+class PooledBuffer(object):
+  """One filled buffer on loan from a BufferPool.
+
+  data is a memoryview of the bytes read, valid until release(). Use it as
+  a context manager to release it automatically:
+
+    with pool.read() as buf:
+      cols = buf.columns()
+  """
+  __slots__ = ("pool", "buf", "length", "t", "host_t", "err")
+
+  def __init__(self, pool, buf):
+    self.pool = pool
+    self.buf = buf
+    self.length = 0
+    self.t = None
+    # per frame host times and error estimates, set when the panda's CanClock is on
+    self.host_t = None
+    self.err = None
+
+  @property
+  def data(self):
+    return memoryview(self.buf)[:self.length]
+
+  def __len__(self):
+    return self.length
+
+  def batch(self):
+    # lazy CanFrameBatch over the pooled bytes
+    batch = CanFrameBatch(self.data, self.t)
+    batch.host_t, batch.err = self.host_t, self.err
+    return batch
+
+  def columns(self):
+    # CanColumns, the data column is a view of the pooled bytes
+    return parse_can_buffer_columnar(self.data)
+
+  def release(self):
+    self.pool.release(self)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.release()
+
+
+class BufferPool(object):
+  """Reads endpoint 1 into n_buffers preallocated bytearrays.
+
+  libusb fills the pooled buffers in place (bulk transfers set up on the
+  bytearray, nothing is allocated per read) and keeps up to `transfers`
+  reads queued on the device. A buffer goes back to the pool when the
+  consumer releases it; until then no transfer reuses it, so holding on
+  to all of them stalls the receive path rather than corrupting data.
+
+    pool = panda.enable_buffer_pool()
+    buf = pool.read()
+    try:
+      handle(buf.batch())
+    finally:
+      buf.release()
+  """
+
+  def __init__(self, panda, n_buffers=8, size=0x10*256, transfers=2, idle_sleep=0.001):
+    assert not panda.wifi, "buffer pool needs a USB panda"
+    assert 0 < transfers <= n_buffers
+    self.panda = panda
+    self.size = size
+    self.n_transfers = transfers
+    self.idle_sleep = idle_sleep
+    self._lock = threading.Lock()
+    self._free = collections.deque(PooledBuffer(self, bytearray(size)) for _ in range(n_buffers))
+    self._ready = collections.deque()
+    self._idle = []
+    self._transfers = []
+    self._in_flight = {}
+    # panda._generation the transfers were made for
+    self._generation = None
+    # the RetryState of the current run of failed reads, and when the next
+    # retry may be submitted; _error is (RECONNECT or RAISE, error) for read()
+    self._retry = None
+    self._retry_at = 0.
+    self._error = None
+
+    self.reads = 0
+    self.empty_reads = 0
+    self.transfer_errors = 0
+    self.starved = 0
+    # buffers left out of the pool because their read never completed
+    self.abandoned = 0
+
+  def _setup(self):
+    # (re)create the transfers when the panda reconnected, a rewrapped
+    # handle (enable_auto_reconnect) is still the same device handle
+    generation = self.panda._generation
+    if self._transfers and generation == self._generation:
+      return
+    if self._transfers:
+      self._drain(DRAIN_TIMEOUT)
+    self._generation = generation
+    self._transfers = [self.panda._handle.getTransfer() for _ in range(self.n_transfers)]
+    self._idle = list(self._transfers)
+
+  def _drain(self, timeout):
+    # cancels the queued reads and lets them complete, so libusb is done
+    # with their buffers before those go back to the pool
+    with self._lock:
+      in_flight = list(self._in_flight)
+    for transfer in in_flight:
+      try:
+        transfer.cancel()
+      except usb1.USBError:
+        # already done, or the device is gone
+        pass
+    end = monotonic() + timeout
+    while self._in_flight and monotonic() < end:
+      self.panda._context.handleEventsTimeout(self.idle_sleep)
+    with self._lock:
+      stale = list(self._in_flight.items())
+      self._in_flight.clear()
+    for transfer, buf in stale:
+      if transfer.isSubmitted():
+        # libusb may still write into it, never hand it out again
+        self.abandoned += 1
+      else:
+        self._release(buf)
+
+  def _submit_idle(self):
+    if self._retry is not None and monotonic() < self._retry_at:
+      # backing off after a failed read
+      return
+    while True:
+      with self._lock:
+        if not self._idle:
+          return
+        if not self._free:
+          self.starved += 1
+          return
+        buf = self._free.popleft()
+        transfer = self._idle.pop()
+        # no copy, libusb reads straight into the pooled bytearray
+        transfer.setBulk(CAN_IN_ENDPOINT, buf.buf, callback=self._on_done)
+        # the completion can run before submit() returns
+        self._in_flight[transfer] = buf
+      try:
+        transfer.submit()
+      except usb1.USBError as e:
+        # never queued, so no callback will hand either back
+        with self._lock:
+          self._in_flight.pop(transfer, None)
+          self._idle.append(transfer)
+        self._release(buf)
+        self._failed(e)
+        return
+
+  def _on_done(self, transfer):
+    # runs on whichever thread handles libusb events
+    status = transfer.getStatus()
+    with self._lock:
+      buf = self._in_flight.pop(transfer, None)
+      if buf is None:
+        # reclaimed by close() or a reconnect, the buffer is already free
+        return
+      self._idle.append(transfer)
+      if status == usb1.TRANSFER_COMPLETED and transfer.getActualLength():
+        buf.length = transfer.getActualLength()
+        buf.t = monotonic()
+        self._ready.append(buf)
+        self._retry = None
+        return
+    self._release(buf)
+    if status == usb1.TRANSFER_COMPLETED:
+      self.empty_reads += 1
+      self._retry = None
+    elif status != usb1.TRANSFER_CANCELLED:
+      self._failed(transfer_error(status))
+
+  def _failed(self, e):
+    # on the event thread, so read() does the reconnecting or raising
+    self.transfer_errors += 1
+    if self._error is not None:
+      # another read of the same burst, read() hasn't acted on the first yet
+      self.panda.can_stats.record_error(e)
+      return
+    if self._retry is None:
+      self._retry = self.panda.retry_policy.tracker(self.panda.can_stats, "recv_retries",
+                                                    "CAN: BAD RECV")
+    action = self._retry.failed(e)
+    if action == RetryPolicy.RETRY:
+      self._retry_at = monotonic() + self._retry.delay()
+    else:
+      self._error = (action, e)
+
+  def read(self, timeout=None):
+    """Returns the next non empty PooledBuffer, or None after timeout seconds."""
+    end = None if timeout is None else monotonic() + timeout
+    context = self.panda._context
+    self._setup()
+    while not self._ready:
+      if self._error is not None:
+        (action, e), self._error = self._error, None
+        if action == RetryPolicy.RAISE:
+          self._retry = None
+          raise e
+        self.panda.reconnect(self._generation)
+        self._setup()
+      self._submit_idle()
+      context.handleEventsTimeout(self.idle_sleep)
+      if self._ready:
+        break
+      if end is not None and monotonic() >= end:
+        return None
+      if len(self._idle) == len(self._transfers):
+        # nothing in flight: the device had nothing, we're starved or backing off
+        time.sleep(self.idle_sleep)
+    self._submit_idle()
+    with self._lock:
+      buf = self._ready.popleft()
+    self.reads += 1
+    self.panda.can_stats.record_rx(buf.data)
+    batch = CanFrameBatch(buf.data, buf.t)
+    self.panda._on_read(batch)
+    buf.host_t, buf.err = batch.host_t, batch.err
+    return buf
+
+  def _release(self, buf):
+    buf.length = 0
+    buf.t = buf.host_t = buf.err = None
+    with self._lock:
+      self._free.append(buf)
+
+  def release(self, buf):
+    """Returns a buffer handed out by read() to the pool, thread safe."""
+    assert buf.pool is self
+    if buf.length:
+      # released buffers are empty, so a second release is a no-op
+      self._release(buf)
+
+  def available(self):
+    with self._lock:
+      return len(self._free)
+
+  def close(self, timeout=DRAIN_TIMEOUT):
+    """Cancels the queued reads, buffers already handed out stay valid."""
+    self._drain(timeout)
+    with self._lock:
+      # reclaim the reads nobody picked up
+      stale = list(self._ready)
+      self._ready.clear()
+    for buf in stale:
+      self._release(buf)
+    self._generation = None
+    self._transfers = []
+    self._idle = []
@@ -0,0 +1,136 @@
+# host side CAN id filtering and per id dispatch, checked before payload slicing
+import numpy as np
+
+from .columnar import CAN_FRAME_HEADER
+
+STD_IDS = 0x800 # 11 bit ids, 2048 = 0x800
+
+
+class _BusTable(object):
+  # compiled lookup for one bus: None = rejected, otherwise a tuple of callbacks
+  __slots__ = ("std", "std_mask", "ext_allow", "ext_deny", "ext_callbacks")
+
+  def __init__(self, allow, deny, callbacks):
+    self.std = [None] * STD_IDS
+    for address in range(STD_IDS):
+      if address not in deny and (allow is None or address in allow):
+        self.std[address] = tuple(callbacks.get(address, ()))
+    self.std_mask = np.array([x is not None for x in self.std], dtype=bool)
+    self.ext_allow = None if allow is None else frozenset(a for a in allow if a >= STD_IDS)
+    self.ext_deny = frozenset(a for a in deny if a >= STD_IDS)
+    self.ext_callbacks = dict((a, tuple(cbs)) for a, cbs in callbacks.items() if a >= STD_IDS)
+
+  def lookup(self, address):
+    if address < STD_IDS:
+      return self.std[address]
+    if address in self.ext_deny or (self.ext_allow is not None and address not in self.ext_allow):
+      return None
+    return self.ext_callbacks.get(address, ())
+
+  def mask(self, address):
+    ok = np.zeros(len(address), dtype=bool)
+    std = address < STD_IDS
+    ok[std] = self.std_mask[address[std]]
+    ext = ~std
+    if ext.any():
+      ext_address = address[ext]
+      ext_ok = ~np.isin(ext_address, list(self.ext_deny))
+      if self.ext_allow is not None:
+        ext_ok &= np.isin(ext_address, list(self.ext_allow))
+      ok[ext] = ext_ok
+    return ok
+
+
+class CanFilter(object):
+  """Allow/deny sets and callbacks per bus, compiled into one lookup index.
+
+  Rules with bus=None apply to every bus. A bus with no allow rules accepts
+  every address that is not denied. Callbacks are called as
+  callback(address, bus_time, dat, src) for accepted frames only.
+
+    f = CanFilter()
+    f.allow([0x1d0, 0x2e4], bus=0)
+    f.on(0x1d0, handle_speed)
+    frames = parse_can_buffer(dat, f)
+  """
+
+  def __init__(self):
+    self._allow = {}
+    self._deny = {}
+    self._callbacks = {}
+    self._tables = None
+
+  def _rules(self, rules, bus):
+    self._tables = None
+    return rules.setdefault(bus, set())
+
+  def allow(self, addresses, bus=None):
+    self._rules(self._allow, bus).update(addresses)
+
+  def deny(self, addresses, bus=None):
+    self._rules(self._deny, bus).update(addresses)
+
+  def on(self, address, callback, bus=None):
+    self._tables = None
+    self._callbacks.setdefault(bus, {}).setdefault(address, []).append(callback)
+
+  def clear(self):
+    self.__init__()
+
+  def compile(self):
+    def table(bus):
+      allow = None
+      if None in self._allow or bus in self._allow:
+        allow = self._allow.get(None, set()) | self._allow.get(bus, set())
+      deny = self._deny.get(None, set()) | self._deny.get(bus, set())
+      callbacks = {}
+      for b in (None, bus):
+        for address, cbs in self._callbacks.get(b, {}).items():
+          callbacks.setdefault(address, []).extend(cbs)
+      return _BusTable(allow, deny, callbacks)
+
+    buses = (set(self._allow) | set(self._deny) | set(self._callbacks)) - set([None])
+    tables = dict((bus, table(bus)) for bus in buses)
+    tables[None] = table(None)
+    self._tables = tables
+    return tables
+
+  def lookup(self, bus, address):
+    tables = self._tables or self.compile()
+    return tables.get(bus, tables[None]).lookup(address)
+
+  def accepts(self, bus, address):
+    return self.lookup(bus, address) is not None
+
+  def parse(self, dat):
+    # parse_can_buffer for accepted frames only, dispatching callbacks as it goes
+    tables = self._tables or self.compile()
+    default = tables[None]
+    if isinstance(dat, memoryview):
+      # the frames outlive the buffer (a pooled one gets reused), copy once
+      dat = dat.tobytes()
+    ret = []
+    for off in range(0, len(dat) - len(dat) % 0x10, 0x10):
+      f1, f2 = CAN_FRAME_HEADER.unpack_from(dat, off)
+      address = f1 >> 3 if f1 & 4 else f1 >> 21
+      src = (f2 >> 4) & 0xFF
+      callbacks = tables.get(src, default).lookup(address)
+      if callbacks is None:
+        continue
+      frame = (address, f2 >> 16, dat[off+8:off+8+min(f2 & 0xF, 8)], src)
+      ret.append(frame)
+      for callback in callbacks:
+        callback(*frame)
+    return ret
+
+  def mask(self, cols):
+    # boolean keep mask for a CanColumns batch, no callbacks
+    tables = self._tables or self.compile()
+    keep = np.zeros(len(cols), dtype=bool)
+    for src in np.unique(cols.src).tolist():
+      sel = cols.src == src
+      keep[sel] = tables.get(src, tables[None]).mask(cols.address[sel])
+    return keep
+
+  def filter(self, cols):
+    return cols[self.mask(cols)]
@@ -0,0 +1,210 @@
+# chunked, compressed columnar CAN log with per chunk time range and address bitmap
+import mmap
+import struct
+import zlib
+
+import numpy as np
+
+from .columnar import CanColumns, parse_can_buffer_columnar
+
+FILE_MAGIC = b"PANDACOL"
+FILE_VERSION = 1
+_FILE_HEADER = struct.Struct("<8sI")
+
+# magic, frame count, first/last host time, compressed size, crc32 of the
+# compressed columns, bitmask of buses (src & 7) present
+CHUNK_MAGIC = b"CCHK"
+_CHUNK_HEADER = struct.Struct("<4sIddIIB")
+# one bit per (address & 0xFFF), exact for 11 bit ids
+BITMAP_BITS = 0x1000
+BITMAP_BYTES = BITMAP_BITS // 8
+
+# column order inside a chunk
+_COLUMNS = (("t", np.float64, 1), ("address", np.uint32, 1), ("bus_time", np.uint16, 1),
+            ("src", np.uint8, 1), ("length", np.uint8, 1), ("data", np.uint8, 8))
+
+
+def address_bitmap(address):
+  bits = np.zeros(BITMAP_BITS, dtype=np.uint8)
+  bits[np.asarray(address, dtype=np.uint32) & (BITMAP_BITS - 1)] = 1
+  # little endian bit order within each byte, packbits only does big endian before numpy 1.17
+  return np.packbits(bits.reshape(-1, 8)[:, ::-1]).tobytes()
+
+
+class CanLogWriter(object):
+  """Writes CanColumns batches (with host times) into an indexed log.
+
+    log = CanLogWriter("drive.canlog")
+    log.write(parse_can_buffer_columnar(dat), t)
+    log.close()
+  """
+
+  def __init__(self, fn, chunk_frames=0x4000, level=6):
+    self.fn = fn
+    self.chunk_frames = chunk_frames
+    self.level = level
+    self._f = open(fn, "wb")
+    self._f.write(_FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION))
+    self._pending = []
+    self._t = []
+    self._n = 0
+    self.frames = 0
+    self.chunks = 0
+
+  def write(self, cols, t):
+    """Args:
+      cols (CanColumns): frames to append
+      t (float or float array): host time of the read, or one per frame
+    """
+    n = len(cols)
+    if n == 0:
+      return
+    self._pending.append(cols)
+    self._t.append(np.broadcast_to(np.asarray(t, dtype=np.float64), (n,)))
+    self._n += n
+    if self._n >= self.chunk_frames:
+      self.flush()
+
+  def write_batch(self, batch):
+    self.write(parse_can_buffer_columnar(batch.buffer), batch.t)
+
+  def flush(self):
+    if not self._pending:
+      return
+    cols = CanColumns.concatenate(self._pending)
+    t = np.concatenate(self._t)
+    self._pending, self._t, self._n = [], [], 0
+
+    values = {"t": t, "address": cols.address, "bus_time": cols.bus_time,
+              "src": cols.src, "length": cols.length, "data": cols.data}
+    raw = b"".join(np.ascontiguousarray(values[name], dtype=dtype).tobytes()
+                   for name, dtype, _ in _COLUMNS)
+    payload = zlib.compress(raw, self.level)
+    buses = 0
+    for src in np.unique(cols.src & 7).tolist():
+      buses |= 1 << src
+    self._f.write(_CHUNK_HEADER.pack(CHUNK_MAGIC, len(t), float(t.min()), float(t.max()),
+                                     len(payload), zlib.crc32(payload) & 0xFFFFFFFF, buses))
+    self._f.write(address_bitmap(cols.address))
+    self._f.write(payload)
+    self.frames += len(t)
+    self.chunks += 1
+
+  def close(self):
+    self.flush()
+    self._f.close()
+
+
+class LogChunk(object):
+  __slots__ = ("offset", "n", "t_min", "t_max", "size", "crc", "buses", "bitmap")
+
+  def __init__(self, offset, n, t_min, t_max, size, crc, buses, bitmap):
+    self.offset = offset
+    self.n = n
+    self.t_min = t_min
+    self.t_max = t_max
+    self.size = size
+    self.crc = crc
+    self.buses = buses
+    self.bitmap = bitmap
+
+  def may_contain(self, address_bits=None, t0=None, t1=None, bus=None):
+    if t0 is not None and self.t_max < t0:
+      return False
+    if t1 is not None and self.t_min > t1:
+      return False
+    if bus is not None and not self.buses & (1 << (bus & 7)):
+      return False
+    if address_bits is not None and not (self.bitmap & address_bits).any():
+      return False
+    return True
+
+
+class CanLogReader(object):
+  """Memory maps a CanLogWriter file and decompresses only matching chunks.
+
+    log = CanLogReader("drive.canlog")
+    for t, cols in log.query(addresses=[0x1d0], t0=start+720, t1=start+780):
+      ...
+  """
+
+  def __init__(self, fn):
+    self._f = open(fn, "rb")
+    self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version = _FILE_HEADER.unpack_from(self._mm, 0)
+    assert magic == FILE_MAGIC, "%s is not a panda CAN log" % fn
+    assert version == FILE_VERSION
+    self.chunks = self._index()
+
+  def _index(self):
+    chunks = []
+    off = _FILE_HEADER.size
+    end = len(self._mm)
+    while off + _CHUNK_HEADER.size + BITMAP_BYTES <= end:
+      magic, n, t_min, t_max, size, crc, buses = _CHUNK_HEADER.unpack_from(self._mm, off)
+      if magic != CHUNK_MAGIC:
+        break
+      data_off = off + _CHUNK_HEADER.size
+      if data_off + BITMAP_BYTES + size > end:
+        # truncated last chunk
+        break
+      bitmap = np.frombuffer(self._mm, dtype=np.uint8, count=BITMAP_BYTES, offset=data_off).copy()
+      chunks.append(LogChunk(data_off + BITMAP_BYTES, n, t_min, t_max, size, crc, buses, bitmap))
+      off = data_off + BITMAP_BYTES + size
+    return chunks
+
+  @property
+  def t_min(self):
+    return min(c.t_min for c in self.chunks) if self.chunks else None
+
+  @property
+  def t_max(self):
+    return max(c.t_max for c in self.chunks) if self.chunks else None
+
+  def read_chunk(self, chunk):
+    """Returns (t, CanColumns) for every frame in the chunk."""
+    payload = self._mm[chunk.offset:chunk.offset + chunk.size]
+    if zlib.crc32(payload) & 0xFFFFFFFF != chunk.crc:
+      raise ValueError("corrupt chunk at offset %d" % chunk.offset)
+    raw = zlib.decompress(payload)
+    n = chunk.n
+    values = {}
+    off = 0
+    for name, dtype, width in _COLUMNS:
+      count = n * width
+      values[name] = np.frombuffer(raw, dtype=dtype, count=count, offset=off)
+      off += count * np.dtype(dtype).itemsize
+    cols = CanColumns(values["address"], values["bus_time"], values["length"], values["src"],
+                      values["data"].reshape(n, 8))
+    return values["t"], cols
+
+  def query(self, addresses=None, t0=None, t1=None, bus=None):
+    """Yields (t, CanColumns) per matching chunk, filtered to matching frames."""
+    address_bits = None
+    if addresses is not None:
+      addresses = np.asarray(list(addresses), dtype=np.uint32)
+      address_bits = np.frombuffer(address_bitmap(addresses), dtype=np.uint8)
+    for chunk in self.chunks:
+      if not chunk.may_contain(address_bits, t0, t1, bus):
+        continue
+      t, cols = self.read_chunk(chunk)
+      keep = np.ones(len(t), dtype=bool)
+      if t0 is not None:
+        keep &= t >= t0
+      if t1 is not None:
+        keep &= t <= t1
+      if bus is not None:
+        keep &= cols.src == bus
+      if addresses is not None:
+        keep &= np.isin(cols.address, addresses)
+      if keep.any():
+        yield t[keep], cols[keep]
+
+  def __iter__(self):
+    for chunk in self.chunks:
+      yield self.read_chunk(chunk)
+
+  def close(self):
+    self.chunks = []
+    self._mm.close()
+    self._f.close()
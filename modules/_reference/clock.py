@@ -0,0 +1,179 @@
+# maps the panda's 16 bit CAN timestamps onto the host clock
+import collections
+import time
+
+import numpy as np
+
+from .columnar import parse_can_buffer_columnar
+
+# TIM2 runs at 1MHz, bus_time is its low 16 bits
+DEVICE_TICK_HZ = 1000000
+DEVICE_TIMER_BITS = 16
+
+# host monotonic clock, python 2 only has time.time
+monotonic = getattr(time, "monotonic", time.time)
+
+
+class TimestampUnwrapper(object):
+  """Turns the wrapping device timer into a monotonically increasing count.
+
+  Frames within one bulk read are assumed less than one timer period
+  apart. Between reads the host time of the reads tells how many periods
+  went by, so idle buses and slow readers don't lose wraps.
+  """
+
+  def __init__(self, tick_hz=DEVICE_TICK_HZ, bits=DEVICE_TIMER_BITS):
+    self.tick_hz = tick_hz
+    self.period = 1 << bits
+    self.reset()
+
+  def reset(self):
+    self._last = None
+    self._last_raw = None
+    self._last_t = None
+
+  def unwrap(self, bus_time, t_read=None):
+    """Args:
+      bus_time (uint16[n]): raw timer values in receive order
+      t_read (float): host time the read completed
+
+    Returns:
+      int64[n] ticks since the first frame seen
+    """
+    raw = np.asarray(bus_time, dtype=np.int64)
+    if not len(raw):
+      return raw
+    rel = np.zeros(len(raw), dtype=np.int64)
+    np.cumsum(np.diff(raw) % self.period, out=rel[1:])
+    if self._last is None:
+      first = 0
+    else:
+      gap = (int(raw[0]) - self._last_raw) % self.period
+      if t_read is not None and self._last_t is not None:
+        # whole periods between the last frame seen and the newest frame
+        # here, the newest frame being close to t_read
+        elapsed = (t_read - self._last_t) * self.tick_hz
+        gap += max(int(round((elapsed - gap - int(rel[-1])) / self.period)), 0) * self.period
+      first = self._last + gap
+    ext = rel + first
+    self._last = int(ext[-1])
+    self._last_raw = int(raw[-1])
+    self._last_t = t_read
+    return ext
+
+
+class ClockModel(object):
+  """host = offset + skew * device seconds, fitted from bulk read completions.
+
+  Each read gives one point (device time of its newest frame, host time
+  the read completed). The frame arrived before the read completed, so all
+  points lie on or above the true line: skew is fitted on the lowest
+  quarter of the points and offset is the minimum over the window.
+  The error estimate covers timer resolution, read delay jitter and skew
+  uncertainty, not the fixed minimum USB latency, which can't be observed.
+  """
+
+  def __init__(self, window=1024, resolution=1.0 / DEVICE_TICK_HZ):
+    self.resolution = resolution
+    self._points = collections.deque(maxlen=window)
+    self.offset = None
+    self.skew = 1.0
+    self.spread = 0.0
+    self._skew_err = 0.0
+    self._center = 0.0
+
+  def add(self, device_t, host_t):
+    self._points.append((device_t, host_t))
+
+  def fit(self):
+    if not self._points:
+      return
+    pts = np.array(self._points, dtype=np.float64)
+    d, t = pts[:, 0], pts[:, 1]
+    skew, skew_err = 1.0, 0.0
+    if len(d) >= 8 and np.ptp(d) > 0:
+      skew = _slope(d, t)
+      r = t - skew * d
+      lower = r <= np.percentile(r, 25)
+      if lower.sum() >= 4 and np.ptp(d[lower]) > 0:
+        skew, skew_err = _slope(d[lower], t[lower], True)
+    self.skew = skew
+    self._skew_err = skew_err
+    self._center = float(d.mean())
+    r = t - skew * d
+    self.offset = float(r.min())
+    # how tightly the reads hug the line, i.e. how well the minimum delay is known
+    self.spread = float(np.percentile(r - self.offset, 10))
+
+  def to_host(self, device_t):
+    """Returns (host time, error estimate) for device seconds."""
+    device_t = np.asarray(device_t, dtype=np.float64)
+    if self.offset is None:
+      raise ValueError("clock model has no data yet")
+    host = self.offset + self.skew * device_t
+    err = self.resolution + self.spread + self._skew_err * np.abs(device_t - self._center)
+    return host, err
+
+
+def _slope(x, y, with_err=False):
+  xc = x - x.mean()
+  yc = y - y.mean()
+  sxx = float((xc * xc).sum())
+  b = float((xc * yc).sum()) / sxx
+  if not with_err:
+    return b
+  res = yc - b * xc
+  dof = max(len(x) - 2, 1)
+  return b, float(np.sqrt((res * res).sum() / dof / sxx))
+
+
+class CanClock(object):
+  """Unwrapper and clock model for one panda.
+
+  Feed it every bulk read, in order, with the monotonic() time the read
+  completed. The panda's own clock (Panda.enable_can_clock) is fed by
+  every receive path and stamps their batches; a separate one is fed by
+  hand:
+
+    clock = CanClock()
+    dat = panda._can_read()
+    cols = parse_can_buffer_columnar(dat)
+    host_t, err = clock.annotate(cols, monotonic())
+  """
+
+  def __init__(self, tick_hz=DEVICE_TICK_HZ, bits=DEVICE_TIMER_BITS, window=1024, refit=8):
+    self.tick_hz = float(tick_hz)
+    self.unwrapper = TimestampUnwrapper(tick_hz, bits)
+    self.model = ClockModel(window, 1.0 / tick_hz)
+    # refit after this many reads
+    self.refit = refit
+    self._since_fit = 0
+    self.reads = 0
+
+  def reset(self):
+    self.unwrapper.reset()
+    self.model = ClockModel(self.model._points.maxlen, self.model.resolution)
+    self._since_fit = 0
+
+  def observe(self, cols, t_read):
+    """Unwraps one read and adds it to the model, returns device seconds."""
+    device_t = self.unwrapper.unwrap(cols.bus_time, t_read) / self.tick_hz
+    if len(device_t):
+      self.reads += 1
+      self.model.add(float(device_t[-1]), t_read)
+      self._since_fit += 1
+      if self.model.offset is None or self._since_fit >= self.refit:
+        self.model.fit()
+        self._since_fit = 0
+    return device_t
+
+  def annotate(self, cols, t_read):
+    """Returns (host time, error estimate) float64 arrays, one per frame."""
+    return self.model.to_host(self.observe(cols, t_read)) if len(cols) else \
+      (np.zeros(0), np.zeros(0))
+
+  def annotate_batch(self, batch):
+    # CanFrameBatch, t_read is the batch's host time
+    cols = parse_can_buffer_columnar(batch.buffer)
+    host_t, err = self.annotate(cols, batch.t)
+    return cols, host_t, err
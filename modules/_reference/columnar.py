@@ -0,0 +1,116 @@
+# columnar (numpy) decoding of the panda CAN bulk buffer
+import struct
+
+import numpy as np
+
+# one 16 byte record per frame, as sent over bulk endpoint 1
+#   f1 (RIR): address, bit 2 = extended id
+#   f2 (RDTR): bits 0-3 = length, bits 4-11 = src bus, bits 16-31 = bus time
+CAN_FRAME_DTYPE = np.dtype([("f1", "<u4"), ("f2", "<u4"), ("data", "u1", (8,))])
+# f1 and f2 of one record, for decoding without numpy
+CAN_FRAME_HEADER = struct.Struct("II")
+
+# below this many frames the per call numpy overhead outweighs the struct loop
+COLUMNAR_MIN_FRAMES = 64
+
+
+class CanColumns(object):
+  """Frames from one or more bulk reads, one numpy array per field.
+
+  Attributes:
+    address (uint32[n]): arbitration id, extended/standard already split
+    bus_time (uint16[n]): raw device timer
+    length (uint8[n]): payload length, clipped to 8
+    src (uint8[n]): source bus (0x80 set for tx echo)
+    data (uint8[n, 8]): payloads, bytes past length are garbage
+  """
+  __slots__ = ("address", "bus_time", "length", "src", "data")
+
+  def __init__(self, address, bus_time, length, src, data):
+    self.address = address
+    self.bus_time = bus_time
+    self.length = length
+    self.src = src
+    self.data = data
+
+  def __len__(self):
+    return len(self.address)
+
+  def __getitem__(self, idx):
+    # mask or slice, returns a new CanColumns
+    return CanColumns(self.address[idx], self.bus_time[idx], self.length[idx],
+                      self.src[idx], self.data[idx])
+
+  def to_tuples(self, payload=bytes):
+    # same output as parse_can_buffer, payloads sliced from one copy of the
+    # data column; payload (bytes or bytearray) is the type of that copy
+    raw = payload(self.data.tobytes())
+    return [(address, bus_time, raw[off:off+length], src) for address, bus_time, off, length, src in
+            zip(self.address.tolist(), self.bus_time.tolist(), range(0, 8*len(self), 8),
+                self.length.tolist(), self.src.tolist())]
+
+  @staticmethod
+  def from_tuples(frames):
+    # list of (address, bus_time, dat, src) as returned by parse_can_buffer
+    n = len(frames)
+    data = np.zeros((n, 8), dtype=np.uint8)
+    length = np.zeros(n, dtype=np.uint8)
+    for i, frame in enumerate(frames):
+      dat = frame[2]
+      data[i, :len(dat)] = bytearray(dat)
+      length[i] = len(dat)
+    return CanColumns(np.array([f[0] for f in frames], dtype=np.uint32),
+                      np.array([f[1] for f in frames], dtype=np.uint16),
+                      length,
+                      np.array([f[3] for f in frames], dtype=np.uint8),
+                      data)
+
+  @staticmethod
+  def concatenate(cols):
+    cols = list(cols)
+    return CanColumns(np.concatenate([c.address for c in cols]),
+                      np.concatenate([c.bus_time for c in cols]),
+                      np.concatenate([c.length for c in cols]),
+                      np.concatenate([c.src for c in cols]),
+                      np.concatenate([c.data for c in cols]))
+
+
+def can_frames_view(dat):
+  # zero copy view of the bulk buffer as structured records
+  n = len(dat) // 0x10
+  if isinstance(dat, memoryview):
+    # python 2 numpy can't frombuffer() a memoryview
+    return np.asarray(dat)[:n*0x10].view(CAN_FRAME_DTYPE)
+  return np.frombuffer(dat, dtype=CAN_FRAME_DTYPE, count=n)
+
+
+def parse_can_buffer_columnar(dat):
+  recs = can_frames_view(dat)
+  f1 = recs["f1"]
+  f2 = recs["f2"]
+  extended = (f1 & 4) != 0
+  address = np.where(extended, f1 >> 3, f1 >> 21).astype(np.uint32)
+  bus_time = (f2 >> 16).astype(np.uint16)
+  length = np.minimum(f2 & 0xF, 8).astype(np.uint8)
+  src = ((f2 >> 4) & 0xFF).astype(np.uint8)
+  return CanColumns(address, bus_time, length, src, recs["data"])
+
+
+def parse_can_buffer_tuples(dat):
+  # list of (address, bus_time, dat, src), struct loop for small reads.
+  # payloads are slices of the read buffer's type whatever the read size:
+  # bytearray for usb1's bulkRead, bytes for bytes and memoryviews
+  if len(dat) // 0x10 >= COLUMNAR_MIN_FRAMES:
+    return parse_can_buffer_columnar(dat).to_tuples(bytearray if isinstance(dat, bytearray) else bytes)
+  if isinstance(dat, memoryview):
+    dat = dat.tobytes()
+  ret = []
+  for j in range(0, len(dat), 0x10): # 0x10 = 16
+    ddat = dat[j:j+0x10]
+    f1, f2 = struct.unpack("II", ddat[0:8])
+    if f1 & 4: # extended
+      address = f1 >> 3
+    else:
+      address = f1 >> 21
+    ret.append((address, f2>>16, ddat[8:8+(f2&0xF)], (f2>>4)&0xFF))
+  return ret
@@ -0,0 +1,186 @@
+# DBC signal decoding, each message compiled to masks/shifts for vectorized decode
+import re
+
+import numpy as np
+
+from .columnar import CanColumns
+
+_BO = re.compile(r"^BO_\s+(\d+)\s+(\w+)\s*:\s*(\d+)")
+_SG = re.compile(r"^SG_\s+(\w+)\s*(M|m\d+)?\s*:\s*(\d+)\|(\d+)@([01])([+-])\s*"
+                 r"\(\s*([^,\s]+)\s*,\s*([^)\s]+)\s*\)")
+
+
+class DbcSignal(object):
+  __slots__ = ("name", "start", "size", "little_endian", "signed", "factor", "offset",
+               "multiplexor", "mux_value", "shift", "mask", "min_length")
+
+  def __init__(self, name, start, size, little_endian, signed, factor=1.0, offset=0.0,
+               multiplexor=False, mux_value=None):
+    self.name = name
+    self.start = start
+    self.size = size
+    self.little_endian = little_endian
+    self.signed = signed
+    self.factor = factor
+    self.offset = offset
+    self.multiplexor = multiplexor
+    self.mux_value = mux_value
+
+    if little_endian:
+      # intel: start is the lsb, payload read as a little endian u64
+      lsb = start
+      self.min_length = (start + size - 1) // 8 + 1
+    else:
+      # motorola: start is the msb in dbc bit numbering, payload read as a big endian u64
+      msb = (7 - start // 8) * 8 + start % 8
+      lsb = msb - size + 1
+      self.min_length = 8 - lsb // 8
+    assert 0 <= lsb and lsb + size <= 64, "signal %s does not fit in 8 bytes" % name
+    self.shift = lsb
+    self.mask = (1 << size) - 1
+
+
+class DbcMessage(object):
+  def __init__(self, address, name, dlc):
+    self.address = address
+    self.name = name
+    self.dlc = dlc
+    self.signals = []
+    self._compiled = None
+
+  def compile(self):
+    sigs = self.signals
+    self._compiled = {
+      "le": np.array([s.little_endian for s in sigs], dtype=bool),
+      "shift": np.array([s.shift for s in sigs], dtype=np.uint64),
+      "mask": np.array([s.mask for s in sigs], dtype=np.uint64),
+      "sign_bit": np.array([1 << (s.size - 1) if s.signed and s.size < 64 else 0 for s in sigs], dtype=np.uint64),
+      "sign_sub": np.array([float(1 << s.size) if s.signed else 0.0 for s in sigs], dtype=np.float64),
+      "factor": np.array([s.factor for s in sigs], dtype=np.float64),
+      "offset": np.array([s.offset for s in sigs], dtype=np.float64),
+      "min_length": np.array([s.min_length for s in sigs], dtype=np.uint8),
+    }
+    return self._compiled
+
+  def decode(self, data, length=None):
+    """Decodes payload rows (uint8[n, 8]) into {signal name: float64[n]}.
+
+    Signals that don't fit in a frame's length, or whose multiplexor value
+    doesn't match, are NaN.
+    """
+    c = self._compiled or self.compile()
+    data = np.ascontiguousarray(data, dtype=np.uint8)
+    le = data.view("<u8").astype(np.uint64)
+    be = data.view(">u8").astype(np.uint64)
+    # (n, signals)
+    words = np.where(c["le"], le, be)
+    raw = (words >> c["shift"]) & c["mask"]
+    val = raw.astype(np.float64)
+    val -= np.where(raw & c["sign_bit"], c["sign_sub"], 0.0)
+    val = val * c["factor"] + c["offset"]
+    if length is not None:
+      val[np.asarray(length)[:, None] < c["min_length"]] = np.nan
+
+    ret = {}
+    mux = None
+    for i, sig in enumerate(self.signals):
+      ret[sig.name] = val[:, i]
+      if sig.multiplexor:
+        mux = raw[:, i]
+    if mux is not None:
+      for sig in self.signals:
+        if sig.mux_value is not None:
+          ret[sig.name][mux != sig.mux_value] = np.nan
+    return ret
+
+
+class CanDatabase(object):
+  """Messages and signals from a DBC file.
+
+    db = CanDatabase.from_file("honda_civic.dbc")
+    signals = db.decode(panda.can_recv())
+    signals["ENGINE_DATA"]["XMISSION_SPEED"]
+  """
+
+  def __init__(self, dbc_text=""):
+    self.messages = {}
+    self._by_name = {}
+    self._addresses = np.zeros(0, dtype=np.uint32)
+    if dbc_text:
+      self.parse(dbc_text)
+
+  @classmethod
+  def from_file(cls, fn):
+    with open(fn) as f:
+      return cls(f.read())
+
+  def parse(self, dbc_text):
+    msg = None
+    for line in dbc_text.splitlines():
+      line = line.strip()
+      m = _BO.match(line)
+      if m is not None:
+        raw = int(m.group(1))
+        if raw & 0x40000000:
+          # VECTOR__INDEPENDENT_SIG_MSG (0xC0000000) holds unplaced signals, not a frame
+          msg = None
+          continue
+        address = raw & 0x1FFFFFFF # bit 31 marks extended ids
+        msg = DbcMessage(address, m.group(2), int(m.group(3)))
+        self.add_message(msg)
+        continue
+      m = _SG.match(line)
+      if m is not None and msg is not None:
+        name, mux, start, size, order, sign, factor, offset = m.groups()
+        msg.signals.append(DbcSignal(name, int(start), int(size), order == "1", sign == "-",
+                                     float(factor), float(offset),
+                                     multiplexor=(mux == "M"),
+                                     mux_value=int(mux[1:]) if mux and mux != "M" else None))
+
+  def add_message(self, msg):
+    self.messages[msg.address] = msg
+    self._by_name[msg.name] = msg
+    self._addresses = np.array(sorted(self.messages), dtype=np.uint32)
+
+  def message(self, name_or_address):
+    if name_or_address in self._by_name:
+      return self._by_name[name_or_address]
+    return self.messages[name_or_address]
+
+  def decode(self, frames, bus=None, names=None):
+    """Decodes a batch into {message name: {signal name: array}}.
+
+    Args:
+      frames: CanColumns, or a list of tuples as returned by can_recv.
+      bus (int): only decode frames from this bus.
+      names: only decode these messages.
+
+    Each message also gets "index" (positions in the batch), "bus_time"
+    and "src" arrays so signals can be lined up with the frames.
+    """
+    cols = frames if isinstance(frames, CanColumns) else CanColumns.from_tuples(frames)
+    sel = np.isin(cols.address, self._addresses)
+    if bus is not None:
+      sel &= cols.src == bus
+    idx = np.nonzero(sel)[0]
+    if len(idx) == 0:
+      return {}
+    addresses = cols.address[idx]
+    order = np.argsort(addresses, kind="stable")
+    idx = idx[order]
+    addresses = addresses[order]
+    uniq, starts = np.unique(addresses, return_index=True)
+    ends = list(starts[1:]) + [len(idx)]
+
+    ret = {}
+    for address, start, end in zip(uniq.tolist(), starts.tolist(), ends):
+      msg = self.messages[address]
+      if names is not None and msg.name not in names:
+        continue
+      rows = idx[start:end]
+      out = msg.decode(cols.data[rows], cols.length[rows])
+      out["index"] = rows
+      out["bus_time"] = cols.bus_time[rows]
+      out["src"] = cols.src[rows]
+      ret[msg.name] = out
+    return ret
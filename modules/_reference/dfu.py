@@ -1,9 +1,10 @@
 from __future__ import print_function
 import os
-import usb1
 import struct
 import time
 
+from .registry import get_registry, DFU_VID, DFU_PIDS
+
 # *** DFU mode ***
 
 DFU_DNLOAD = 1
@@ -14,30 +15,17 @@ DFU_ABORT = 6
 
 class PandaDFU(object):
   def __init__(self, dfu_serial):
-    context = usb1.USBContext()
-    for device in context.getDeviceList(skip_on_error=True):
-      if device.getVendorID() == 0x0483 and device.getProductID() == 0xdf11:
-        try:
-          this_dfu_serial = device._getASCIIStringDescriptor(3)
-        except Exception:
-          continue
-        if this_dfu_serial == dfu_serial or dfu_serial is None:
-          self._handle = device.open()
-          self.legacy = "07*128Kg" in self._handle.getASCIIStringDescriptor(4)
-          return
-    raise Exception("failed to open "+dfu_serial)
+    for device in get_registry().find(DFU_VID, DFU_PIDS, dfu_serial):
+      self._handle = device.device.open()
+      self.legacy = "07*128Kg" in self._handle.getASCIIStringDescriptor(4)
+      return
+    raise Exception("failed to open "+str(dfu_serial))
 
   @staticmethod
   def list():
-    context = usb1.USBContext()
     dfu_serials = []
     try:
-      for device in context.getDeviceList(skip_on_error=True):
-        if device.getVendorID() == 0x0483 and device.getProductID() == 0xdf11:
-          try:
-            dfu_serials.append(device._getASCIIStringDescriptor(3))
-          except Exception:
-            pass
+      dfu_serials = [device.serial for device in get_registry().find(DFU_VID, DFU_PIDS)]
     except Exception:
       pass
     return dfu_serials
@@ -0,0 +1,187 @@
+# host side TX flow control so can_send_many doesn't overrun the firmware TX queues
+import threading
+import time
+
+import numpy as np
+
+from .clock import monotonic
+from .stats import NUM_BUSES, STD_FRAME_BITS, EXT_FRAME_BITS
+
+# an 8 byte standard frame with worst case bit stuffing, one token
+TOKEN_BITS = 135
+STUFFING = 1.2
+
+
+def frame_tokens(addr, dat):
+  bits = (EXT_FRAME_BITS if addr >= 0x800 else STD_FRAME_BITS) + 8 * len(dat)
+  return bits * STUFFING / TOKEN_BITS
+
+
+# the costliest frame can_send_many takes, an 8 byte extended one
+MAX_FRAME_TOKENS = frame_tokens(0x800, b"\0" * 8)
+
+
+def _array_tokens(addresses, lengths):
+  bits = np.where(addresses >= 0x800, EXT_FRAME_BITS, STD_FRAME_BITS) + 8 * lengths
+  return bits * STUFFING / TOKEN_BITS
+
+
+def _count(counts, buses):
+  # adds the frames per known bus to the list counts
+  known = buses[(buses >= 0) & (buses < NUM_BUSES)]
+  for bus, n in enumerate(np.bincount(known, minlength=NUM_BUSES).tolist()):
+    counts[bus] += n
+
+
+class TxFlowControl(object):
+  """Per bus token buckets in front of the panda's TX queues.
+
+  A bucket holds up to `queue_depth` tokens (about one firmware TX queue
+  slot each) and refills at the bus bitrate from Panda.set_can_speed_kbps.
+  send() splits a batch into bulk writes of at most `max_transfer` frames,
+  only taking from a bus what its bucket allows, and waits for refill
+  instead of overflowing the device and retrying. Frames go out in the
+  order given; a bus that runs out of tokens holds back only its own
+  frames. Waits hold no lock, so other callers (TxLanes HIGH frames among
+  them) wait for at most the write in progress, and report() can be polled
+  while send() waits.
+  """
+
+  def __init__(self, panda, queue_depth=0xC0, max_transfer=0x100, min_transfer=0x10):
+    assert queue_depth >= MAX_FRAME_TOKENS, "queue_depth can't hold one frame"
+    assert max_transfer > 0 and min_transfer > 0
+    self.panda = panda
+    self.queue_depth = queue_depth
+    self.max_transfer = max_transfer
+    # once a bucket is drained, wait for room for this many frames before writing
+    self.min_transfer = min_transfer
+    self._tokens = np.full(NUM_BUSES, float(queue_depth))
+    self._last = monotonic()
+    # _lock guards the buckets and counters, _send_lock makes taking tokens
+    # and writing one transfer atomic, so writes go out in the order taken
+    self._lock = threading.Lock()
+    self._send_lock = threading.Lock()
+
+    self.queued = [0] * NUM_BUSES
+    self.sent = [0] * NUM_BUSES
+    # frames never written because a write failed
+    self.failed = [0] * NUM_BUSES
+    self.transfers = 0
+    self.waits = 0
+    self.wait_time = 0.0
+
+  def _rates(self):
+    # tokens per second per bus
+    return self.panda.can_stats.speed_kbps * 1000. / TOKEN_BITS
+
+  def _refill(self):
+    now = monotonic()
+    dt = now - self._last
+    self._last = now
+    self._tokens = np.minimum(self._tokens + dt * self._rates(), float(self.queue_depth))
+
+  def _batch(self, bus_costs):
+    # frames of one bus worth a write: min_transfer, or what a full bucket holds
+    fits = np.cumsum(bus_costs[:self.min_transfer]) <= self.queue_depth
+    return max(int(fits.sum()), 1)
+
+  def _take(self, buses, costs, pending):
+    # next transfer out of pending (indices in send order): every frame
+    # whose bus still has tokens, up to max_transfer, order unchanged
+    b = buses[pending]
+    ok = (b < 0) | (b >= NUM_BUSES) # not a CAN bus we know the rate of, pass through
+    worth = ok.any()
+    for bus in np.unique(b[~ok]).tolist():
+      m = b == bus
+      # a prefix of each bus' frames, so frames of a bus stay in order
+      ok[m] = np.cumsum(costs[pending[m]]) <= self._tokens[bus]
+      # same threshold _next_token waits for, no trickle of tiny writes
+      worth = worth or ok[m].sum() >= self._batch(costs[pending[m]])
+    take = np.flatnonzero(ok)[:self.max_transfer]
+    if not worth or len(take) == 0:
+      return take[:0], pending
+    ok[:] = False
+    ok[take] = True
+    take = pending[take]
+    known = (buses[take] >= 0) & (buses[take] < NUM_BUSES)
+    tb = buses[take][known]
+    self._tokens -= np.bincount(tb, weights=costs[take][known], minlength=NUM_BUSES)
+    return take, pending[~ok]
+
+  def _next_token(self, buses, costs, pending):
+    # seconds until some bus has room for a batch of its waiting frames
+    rates = self._rates()
+    b = buses[pending]
+    wait = None
+    for bus in np.unique(b).tolist():
+      bus_costs = costs[pending[b == bus]]
+      need = bus_costs[:self._batch(bus_costs)].sum() - self._tokens[bus]
+      w = max(need, 0.) / rates[bus] if rates[bus] > 0 else 0.1
+      wait = w if wait is None else min(wait, w)
+    return wait
+
+  def _send(self, buses, costs, write):
+    # write(indices) sends those frames in one bulk transfer
+    # a frame never costs more than a full bucket, or it would wait forever
+    costs = np.minimum(costs, float(self.queue_depth))
+    pending = np.arange(len(buses))
+    take = pending[:0]
+    with self._lock:
+      _count(self.queued, buses)
+    try:
+      while len(pending):
+        with self._send_lock:
+          with self._lock:
+            self._refill()
+            take, pending = self._take(buses, costs, pending)
+            if not len(take):
+              wait = float(self._next_token(buses, costs, pending))
+              self.waits += 1
+              self.wait_time += wait
+          # write without _lock, report() stays responsive
+          if len(take):
+            write(take)
+        if len(take):
+          with self._lock:
+            self.transfers += 1
+            _count(self.sent, buses[take])
+          take = take[:0]
+        else:
+          # no lock held, other buses and callers keep sending
+          time.sleep(wait)
+    except Exception:
+      with self._lock:
+        _count(self.failed, buses[np.concatenate([take, pending])])
+      raise
+
+  def send(self, arr):
+    # [[addr, _, dat, bus], ...] as passed to can_send_many
+    if not arr:
+      return
+    buses = np.array([frame[3] for frame in arr], dtype=np.intp)
+    costs = np.array([frame_tokens(frame[0], frame[2]) for frame in arr])
+    self._send(buses, costs, lambda idx: self.panda._can_send_many([arr[i] for i in idx.tolist()]))
+
+  def send_arrays(self, addresses, buses, data, lengths=None):
+    # numpy inputs as passed to can_send_arrays
+    addresses = np.asarray(addresses, dtype=np.uint32)
+    n = len(addresses)
+    if n == 0:
+      return
+    data = np.asarray(data, dtype=np.uint8).reshape(n, -1)
+    if lengths is None:
+      lengths = np.full(n, data.shape[1], dtype=np.uint32)
+    lengths = np.asarray(lengths, dtype=np.uint32)
+    buses = np.broadcast_to(np.asarray(buses), (n,)).astype(np.intp)
+    def write(idx):
+      self.panda._can_send_arrays(addresses[idx], buses[idx], data[idx], lengths[idx])
+    self._send(buses, _array_tokens(addresses, lengths), write)
+
+  def report(self):
+    """Frames queued with send() vs written to the panda, per bus."""
+    with self._lock:
+      self._refill()
+      return {"queued": list(self.queued), "sent": list(self.sent), "failed": list(self.failed),
+              "pending": [q - s - f for q, s, f in zip(self.queued, self.sent, self.failed)],
+              "tokens": self._tokens.tolist(), "transfers": self.transfers,
+              "waits": self.waits, "wait_time": self.wait_time}
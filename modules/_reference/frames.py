@@ -0,0 +1,110 @@
+# lazy CAN frame views over the raw bulk buffer
+from .columnar import CAN_FRAME_HEADER
+
+
+class CanFrame(object):
+  """View of one 16 byte frame record, fields are decoded on access.
+
+  Unpacks like the tuples from parse_can_buffer:
+    address, bus_time, dat, src = frame
+  """
+  __slots__ = ("_buf", "_off")
+
+  def __init__(self, buf, off):
+    self._buf = buf
+    self._off = off
+
+  @property
+  def address(self):
+    f1 = CAN_FRAME_HEADER.unpack_from(self._buf, self._off)[0]
+    return f1 >> 3 if f1 & 4 else f1 >> 21
+
+  @property
+  def extended(self):
+    return bool(CAN_FRAME_HEADER.unpack_from(self._buf, self._off)[0] & 4)
+
+  @property
+  def bus_time(self):
+    return CAN_FRAME_HEADER.unpack_from(self._buf, self._off)[1] >> 16
+
+  @property
+  def src(self):
+    return (CAN_FRAME_HEADER.unpack_from(self._buf, self._off)[1] >> 4) & 0xFF
+
+  @property
+  def length(self):
+    return min(CAN_FRAME_HEADER.unpack_from(self._buf, self._off)[1] & 0xF, 8)
+
+  @property
+  def data(self):
+    # memoryview into the batch buffer, use frame.data.tobytes() to keep it
+    return self._buf[self._off+8:self._off+8+self.length]
+
+  @property
+  def raw(self):
+    return self._buf[self._off:self._off+0x10]
+
+  def __iter__(self):
+    f1, f2 = CAN_FRAME_HEADER.unpack_from(self._buf, self._off)
+    yield f1 >> 3 if f1 & 4 else f1 >> 21
+    yield f2 >> 16
+    yield self._buf[self._off+8:self._off+8+min(f2 & 0xF, 8)].tobytes()
+    yield (f2 >> 4) & 0xFF
+
+  def __repr__(self):
+    return "CanFrame(address=0x%x, bus_time=%d, src=%d, data=%s)" % (
+      self.address, self.bus_time, self.src, repr(self.data.tobytes()))
+
+
+class CanFrameBatch(object):
+  """All frames from one bulk read, backed by a single memoryview.
+
+  No per frame work is done until a frame is accessed. Views handed out by
+  the batch keep the underlying buffer alive.
+  """
+  __slots__ = ("_buf", "_n", "t", "host_t", "err")
+
+  def __init__(self, dat, t=None):
+    self._buf = memoryview(dat)
+    self._n = len(self._buf) // 0x10
+    # host monotonic time the buffer was read at, if known
+    self.t = t
+    # per frame host times and error estimates, set when the panda's CanClock is on
+    self.host_t = None
+    self.err = None
+
+  @property
+  def buffer(self):
+    return self._buf[:self._n*0x10]
+
+  def __len__(self):
+    return self._n
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += self._n
+    if i < 0 or i >= self._n:
+      raise IndexError("frame index out of range")
+    return CanFrame(self._buf, i*0x10)
+
+  def __iter__(self):
+    buf = self._buf
+    for off in range(0, self._n*0x10, 0x10):
+      yield CanFrame(buf, off)
+
+  def cursor(self):
+    # yields the same CanFrame moved along the buffer, don't hold on to it
+    frame = CanFrame(self._buf, 0)
+    for off in range(0, self._n*0x10, 0x10):
+      frame._off = off
+      yield frame
+
+  def addresses(self):
+    ret = []
+    for off in range(0, self._n*0x10, 0x10):
+      f1 = CAN_FRAME_HEADER.unpack_from(self._buf, off)[0]
+      ret.append(f1 >> 3 if f1 & 4 else f1 >> 21)
+    return ret
+
+  def to_tuples(self):
+    return [tuple(frame) for frame in self]
@@ -0,0 +1,121 @@
+# background health polling into a fixed size history
+import math
+import threading
+
+import numpy as np
+
+from .clock import monotonic
+
+# field order of Panda.health()
+HEALTH_FIELDS = ("voltage", "current", "started", "controls_allowed",
+                 "gas_interceptor_detected", "started_signal_detected", "started_alt")
+HEALTH_DTYPE = np.dtype([("t", "<f8"), ("voltage", "<u4"), ("current", "<u4"),
+                         ("started", "u1"), ("controls_allowed", "u1"),
+                         ("gas_interceptor_detected", "u1"), ("started_signal_detected", "u1"),
+                         ("started_alt", "u1")])
+FLAG_FIELDS = HEALTH_FIELDS[2:]
+
+
+class HealthSampler(object):
+  """Polls panda health at rate_hz from one thread into a ring of samples.
+
+  Readers never touch USB: latest(), window() and history() read the ring,
+  and on_change callbacks run on the sampler thread when a watched field
+  changes.
+
+    health = panda.start_health_sampler(rate_hz=20.)
+    health.on_change(lambda old, new: print(new), fields=["controls_allowed"])
+    print(health.window(5.)["voltage"]["min"])
+  """
+
+  def __init__(self, panda, rate_hz=10., history=600):
+    assert rate_hz > 0
+    self.panda = panda
+    self.period = 1. / rate_hz
+    self._ring = np.zeros(history, dtype=HEALTH_DTYPE)
+    self._n = 0 # samples taken, the newest is at (_n - 1) % len(ring)
+    self._lock = threading.Lock()
+    self._callbacks = []
+    self._stop = threading.Event()
+    self._thread = None
+
+    self.errors = 0
+    self.last_error = None
+
+  def on_change(self, callback, fields=FLAG_FIELDS):
+    """Calls callback(old, new) with sample dicts when any of fields changes."""
+    self._callbacks.append((callback, tuple(fields)))
+
+  def sample(self):
+    # one poll, normally done by the sampler thread
+    values = self.panda._health_raw()
+    t = monotonic()
+    with self._lock:
+      prev = self._latest() if self._n else None
+      self._ring[self._n % len(self._ring)] = (t,) + tuple(values)
+      self._n += 1
+      new = self._latest()
+    if prev is not None:
+      for callback, fields in self._callbacks:
+        if any(prev[f] != new[f] for f in fields):
+          callback(prev, new)
+    return new
+
+  def _run(self):
+    base = monotonic()
+    k = 0
+    while not self._stop.is_set():
+      try:
+        self.sample()
+      except Exception as e:
+        # keep polling, a reconnecting panda comes back on its own
+        self.errors += 1
+        self.last_error = e
+      # fixed grid, skipping slots the poll overran
+      k = max(k + 1, int(math.floor((monotonic() - base) / self.period)) + 1)
+      self._stop.wait(max(base + k * self.period - monotonic(), 0.))
+
+  def start(self):
+    if self._thread is None:
+      self._stop.clear()
+      self._thread = threading.Thread(target=self._run, name="panda-health")
+      self._thread.daemon = True
+      self._thread.start()
+    return self
+
+  def stop(self):
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+  def _latest(self):
+    # caller holds the lock
+    rec = self._ring[(self._n - 1) % len(self._ring)]
+    return dict((name, rec[name].item()) for name in HEALTH_DTYPE.names)
+
+  def latest(self):
+    """The newest sample as a health() dict plus its time "t", or None."""
+    with self._lock:
+      return self._latest() if self._n else None
+
+  def history(self, seconds=None):
+    """Copy of the samples, oldest first, optionally only the last seconds."""
+    with self._lock:
+      n = min(self._n, len(self._ring))
+      start = self._n - n
+      idx = np.arange(start, self._n) % len(self._ring)
+      ret = self._ring[idx]
+    if seconds is not None and len(ret):
+      ret = ret[ret["t"] >= ret["t"][-1] - seconds]
+    return ret
+
+  def window(self, seconds, fields=("voltage", "current")):
+    """min/max/mean per field over the last seconds of samples."""
+    rec = self.history(seconds)
+    ret = {"samples": len(rec)}
+    for name in fields:
+      col = rec[name].astype(np.float64)
+      ret[name] = {"min": float(col.min()), "max": float(col.max()),
+                   "mean": float(col.mean())} if len(col) else None
+    return ret
@@ -0,0 +1,229 @@
+# several pandas serviced together, one merged CAN stream in host time order
+import threading
+
+import numpy as np
+
+from . import Panda
+from .clock import monotonic
+
+OPENING = "opening"
+OK = "ok"
+RECONNECTING = "reconnecting"
+STOPPED = "stopped"
+
+
+class DeviceWorker(object):
+  """Reads one panda in its own thread, reopening it with backoff on errors."""
+
+  def __init__(self, manager, serial):
+    self.manager = manager
+    self.serial = serial
+    self.panda = None
+    self.status = OPENING
+    self._thread = None
+
+    self.reads = 0
+    self.frames = 0
+    self.errors = 0
+    self.reconnects = 0
+    self.last_error = None
+    self.last_read = None
+    self._failures = 0
+    # (panda, can_stats snapshot) of the previous health() call
+    self._stats = None
+
+  def start(self):
+    self._thread = threading.Thread(target=self._run, name="panda-manager-%s" % self.serial)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def join(self):
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+  def _open(self):
+    self.panda = Panda(self.serial)
+    self.panda.enable_can_clock()
+    if self.status == RECONNECTING:
+      self.reconnects += 1
+    self.status = OK
+
+  def _close(self):
+    if self.panda is not None:
+      try:
+        self.panda.close()
+      except Exception:
+        pass
+      self.panda = None
+
+  def _failed(self, e):
+    self.errors += 1
+    self._failures += 1
+    self.last_error = e
+    self.status = RECONNECTING
+    self._close()
+    m = self.manager
+    m._stop.wait(min(m.backoff * (2 ** (self._failures - 1)), m.max_backoff))
+
+  def _run(self):
+    m = self.manager
+    while not m._stop.is_set():
+      try:
+        if self.panda is None:
+          self._open()
+        cols, host_t, err = self.panda.can_recv_timed()
+      except Exception as e:
+        # only this device backs off, the others keep streaming
+        self._failed(e)
+        continue
+      self._failures = 0
+      self.reads += 1
+      self.last_read = monotonic()
+      if len(cols):
+        self.frames += len(cols)
+        m._push(self.serial, cols, host_t, err)
+      else:
+        m._stop.wait(m.idle_sleep)
+    self._close()
+    self.status = STOPPED
+
+  def health(self):
+    panda = self.panda
+    stats = None
+    if panda is not None:
+      # rates since the previous health() of the same panda
+      prev = self._stats[1] if self._stats is not None and self._stats[0] is panda else None
+      stats = panda.can_stats.snapshot(prev)
+      self._stats = (panda, stats)
+    return {"status": self.status, "reads": self.reads, "frames": self.frames,
+            "errors": self.errors, "reconnects": self.reconnects,
+            "last_error": repr(self.last_error) if self.last_error is not None else None,
+            "since_last_read": None if self.last_read is None else monotonic() - self.last_read,
+            "stats": stats}
+
+
+class PandaManager(object):
+  """Opens a set of pandas concurrently and merges their CAN traffic.
+
+  Every device gets a reader thread and its own CanClock, so frames carry
+  host monotonic times that are comparable across devices. Frames are held
+  for `window` seconds and released in time order; a device that fails is
+  reopened with exponential backoff without holding up the others.
+
+    mgr = PandaManager(["e2a4...", "3f01..."]).start()
+    for t, err, serial, address, bus_time, dat, src in mgr.stream():
+      ...
+
+  Args:
+    serials (list): serials to open, None for every panda plugged in
+    window (float): reorder window in seconds, should cover read latency
+    max_pending (int): frames held before the oldest go out regardless
+  """
+
+  def __init__(self, serials=None, window=0.02, max_pending=0x10000, idle_sleep=0.001,
+               backoff=0.5, max_backoff=30.0):
+    if serials is None:
+      serials = Panda.list()
+    self.window = window
+    self.max_pending = max_pending
+    self.idle_sleep = idle_sleep
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.workers = [DeviceWorker(self, serial) for serial in serials]
+
+    self._cond = threading.Condition()
+    self._stop = threading.Event()
+    self._pending = []
+    self._n_pending = 0
+    self._last_t = None
+    self.frames = 0
+    self.late_frames = 0
+
+  def start(self):
+    self._stop.clear()
+    for worker in self.workers:
+      worker.start()
+    return self
+
+  def stop(self):
+    self._stop.set()
+    for worker in self.workers:
+      worker.join()
+    with self._cond:
+      self._cond.notify_all()
+
+  def _push(self, serial, cols, host_t, err):
+    with self._cond:
+      self._pending.append((serial, host_t, err, cols))
+      self._n_pending += len(cols)
+      self._cond.notify_all()
+
+  def _release(self, cutoff):
+    # caller holds the lock, returns frames up to cutoff in time order
+    if self._n_pending > self.max_pending:
+      t_all = np.sort(np.concatenate([p[1] for p in self._pending]))
+      cutoff = max(cutoff, t_all[self._n_pending - self.max_pending - 1])
+    out = []
+    keep = []
+    for serial, host_t, err, cols in self._pending:
+      ready = host_t <= cutoff
+      if ready.all():
+        out.append((serial, host_t, err, cols))
+      elif ready.any():
+        out.append((serial, host_t[ready], err[ready], cols[ready]))
+        keep.append((serial, host_t[~ready], err[~ready], cols[~ready]))
+      else:
+        keep.append((serial, host_t, err, cols))
+    self._pending = keep
+    if not out:
+      return []
+
+    t = np.concatenate([o[1] for o in out])
+    self._n_pending -= len(t)
+    order = np.argsort(t, kind="mergesort")
+    if self._last_t is not None:
+      self.late_frames += int((t < self._last_t).sum())
+    self._last_t = max(self._last_t, float(t[order[-1]])) if self._last_t is not None \
+      else float(t[order[-1]])
+
+    frames = []
+    for serial, host_t, err, cols in out:
+      for ft, fe, address, bus_time, length, data, src in zip(
+          host_t.tolist(), err.tolist(), cols.address.tolist(), cols.bus_time.tolist(),
+          cols.length.tolist(), cols.data, cols.src.tolist()):
+        frames.append((ft, fe, serial, address, bus_time, data[:length].tobytes(), src))
+    self.frames += len(frames)
+    return [frames[i] for i in order.tolist()]
+
+  def recv(self, timeout=None):
+    """Returns the frames that left the reorder window, oldest first.
+
+    Each frame is (host time, error estimate, serial, address, bus_time,
+    dat, src). Waits up to timeout seconds (None is forever) for frames.
+    """
+    end = None if timeout is None else monotonic() + timeout
+    with self._cond:
+      while True:
+        frames = self._release(monotonic() - self.window)
+        if frames or self._stop.is_set():
+          return frames
+        remaining = None if end is None else end - monotonic()
+        if remaining is not None and remaining <= 0:
+          return frames
+        wait = self.window if remaining is None else min(self.window, remaining)
+        self._cond.wait(wait)
+
+  def flush(self):
+    # everything pending, regardless of the window
+    with self._cond:
+      return self._release(float("inf"))
+
+  def stream(self):
+    while not self._stop.is_set():
+      for frame in self.recv(timeout=0.1):
+        yield frame
+
+  def health(self):
+    """Per serial status, counters and CanStats of the current connection."""
+    return dict((worker.serial, worker.health()) for worker in self.workers)
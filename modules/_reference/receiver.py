@@ -0,0 +1,144 @@
+# background CAN receive thread feeding a bounded ring of frame batches
+import threading
+import time
+
+from .clock import monotonic
+from .frames import CanFrameBatch
+
+
+class CanReceiver(object):
+  """Keeps bulk reads on endpoint 1 running in a dedicated thread.
+
+  Each non-empty read becomes a CanFrameBatch in a preallocated ring of
+  `capacity` slots. When the application falls behind the oldest batch is
+  overwritten and counted in `overflows` / `dropped_frames`, so frames are
+  never lost silently.
+  """
+
+  def __init__(self, panda, capacity=1024, idle_sleep=0.001):
+    self.panda = panda
+    self.capacity = capacity
+    self.idle_sleep = idle_sleep
+
+    self._ring = [None] * capacity
+    self._head = 0 # next slot to read
+    self._count = 0
+    self._cond = threading.Condition()
+    self._thread = None
+    self._running = False
+    self._listeners = []
+
+    self.error = None
+    self.reads = 0
+    self.frames = 0
+    self.overflows = 0
+    self.dropped_frames = 0
+
+  def start(self):
+    if self._thread is not None:
+      return self
+    self.error = None
+    self._running = True
+    self._thread = threading.Thread(target=self._run, name="panda-can-rx")
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def stop(self, timeout=None):
+    self._running = False
+    if self._thread is not None:
+      self._thread.join(timeout)
+      self._thread = None
+    with self._cond:
+      self._cond.notify_all()
+
+  def add_listener(self, fn):
+    """Calls fn(batch) from the receive thread for every batch read.
+
+    Listeners see every batch, even ones later dropped from the ring, and
+    must be quick or they hold up the reads. The write_batch methods of
+    CanRecorder, CanLogWriter and CanShmWriter are made for this; the
+    panda's can_state and can_clock are fed before listeners run.
+    """
+    self._listeners.append(fn)
+
+  def remove_listener(self, fn):
+    self._listeners.remove(fn)
+
+  @property
+  def running(self):
+    return self._running
+
+  def __len__(self):
+    return self._count
+
+  def _run(self):
+    try:
+      while self._running:
+        batch = CanFrameBatch(self.panda._can_read(), monotonic())
+        self.reads += 1
+        # the clock and state table have to see every read, empty ones too
+        self.panda._on_read(batch)
+        if len(batch) == 0:
+          time.sleep(self.idle_sleep)
+          continue
+        for fn in self._listeners:
+          fn(batch)
+        self._push(batch)
+    except Exception as e:
+      self.error = e
+    finally:
+      self._running = False
+      with self._cond:
+        self._cond.notify_all()
+
+  def _push(self, batch):
+    with self._cond:
+      tail = (self._head + self._count) % self.capacity
+      if self._count == self.capacity:
+        # full, overwrite the oldest batch
+        self.overflows += 1
+        self.dropped_frames += len(self._ring[self._head])
+        self._head = (self._head + 1) % self.capacity
+      else:
+        self._count += 1
+      self._ring[tail] = batch
+      self.frames += len(batch)
+      self._cond.notify_all()
+
+  def _pop_all(self):
+    ret = []
+    while self._count:
+      ret.append(self._ring[self._head])
+      self._ring[self._head] = None
+      self._head = (self._head + 1) % self.capacity
+      self._count -= 1
+    return ret
+
+  def drain(self):
+    """Returns all buffered batches without blocking, possibly []."""
+    with self._cond:
+      return self._pop_all()
+
+  def wait(self, timeout=None):
+    """Blocks until at least one batch is buffered or timeout (s) expires.
+
+    Raises the receive thread's exception if it died with nothing buffered.
+    """
+    end = None if timeout is None else monotonic() + timeout
+    with self._cond:
+      while self._count == 0 and self._running:
+        remaining = None if end is None else end - monotonic()
+        if remaining is not None and remaining <= 0:
+          break
+        self._cond.wait(remaining)
+      if self._count == 0 and self.error is not None:
+        raise self.error
+      return self._pop_all()
+
+  def recv(self, timeout=None):
+    # wait() flattened to parse_can_buffer style tuples
+    ret = []
+    for batch in self.wait(timeout):
+      ret += batch.to_tuples()
+    return ret
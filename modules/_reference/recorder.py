@@ -0,0 +1,203 @@
+# append only, chunked, crc checked binary log of raw CAN frames
+import os
+import struct
+import threading
+import zlib
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+import numpy as np
+
+from .clock import monotonic
+
+FILE_MAGIC = b"PANDACAN"
+FILE_VERSION = 1
+_FILE_HEADER = struct.Struct("<8sI")
+
+# magic, record count, crc32 of the records, first and last host time
+CHUNK_MAGIC = b"CHNK"
+_CHUNK_HEADER = struct.Struct("<4sIIdd")
+
+# host timestamp + the 16 byte frame exactly as read from bulk endpoint 1
+RECORD_DTYPE = np.dtype([("t", "<f8"), ("frame", "V16")])
+
+
+class CanRecorder(object):
+  """Records raw bulk reads to an append only file of crc checked chunks.
+
+  write() only queues the buffer, a writer thread packs records into
+  chunks of up to chunk_frames (or chunk_interval seconds), appends each
+  chunk with a single write and fsyncs every fsync_chunks chunks. A torn
+  chunk at the end of the file fails its crc and is dropped on read (and
+  truncated when the file is reopened for appending), so a power loss
+  costs at most the chunks written since the last fsync.
+
+    rec = CanRecorder("drive.can")
+    panda.start_can_receiver().add_listener(rec.write_batch)
+  """
+
+  def __init__(self, fn, chunk_frames=0x1000, chunk_interval=1.0, fsync_chunks=1, queue_size=1024):
+    self.fn = fn
+    self.chunk_frames = chunk_frames
+    self.chunk_interval = chunk_interval
+    self.fsync_chunks = fsync_chunks
+
+    self._queue = queue.Queue(queue_size)
+    self._fd = _open_for_append(fn)
+    self._thread = threading.Thread(target=self._run, name="panda-can-recorder")
+    self._thread.daemon = True
+    self._running = True
+
+    self.error = None
+    self.frames = 0
+    self.chunks = 0
+    self.dropped_reads = 0
+    self.dropped_frames = 0
+    self._thread.start()
+
+  def write(self, dat, t=None):
+    """Queues one raw bulk read, never blocks.
+
+    Drops (and counts) the read if the queue is full, or returns False once
+    the recorder is closed or its writer failed (see error).
+    """
+    if self.error is not None or not self._running:
+      self.dropped_reads += 1
+      self.dropped_frames += len(dat) // 0x10
+      return False
+    if t is None:
+      t = monotonic()
+    try:
+      self._queue.put_nowait((t, memoryview(dat).tobytes()))
+    except queue.Full:
+      self.dropped_reads += 1
+      self.dropped_frames += len(dat) // 0x10
+    return True
+
+  def write_batch(self, batch):
+    return self.write(batch.buffer, batch.t)
+
+  def _run(self):
+    pending = []
+    n = 0
+    unsynced = 0
+    deadline = None
+    try:
+      while True:
+        timeout = None if deadline is None else max(deadline - monotonic(), 0)
+        try:
+          item = self._queue.get(timeout=timeout)
+        except queue.Empty:
+          item = False
+        if item:
+          pending.append(item)
+          n += len(item[1]) // 0x10
+          if deadline is None:
+            deadline = monotonic() + self.chunk_interval
+        if pending and (item is None or item is False or n >= self.chunk_frames):
+          self._write_chunk(pending)
+          pending, n, deadline = [], 0, None
+          unsynced += 1
+          if unsynced >= self.fsync_chunks or item is None:
+            os.fsync(self._fd)
+            unsynced = 0
+        if item is None:
+          break
+    except Exception as e:
+      self.error = e
+    finally:
+      for fn in (os.fsync, os.close):
+        try:
+          fn(self._fd)
+        except OSError as e:
+          # keep the error that stopped the writer
+          if self.error is None:
+            self.error = e
+
+  def _write_chunk(self, pending):
+    n = sum(len(dat) // 0x10 for _, dat in pending)
+    rec = np.empty(n, dtype=RECORD_DTYPE)
+    i = 0
+    for t, dat in pending:
+      k = len(dat) // 0x10
+      rec["t"][i:i+k] = t
+      rec["frame"][i:i+k] = np.frombuffer(dat, dtype="V16", count=k)
+      i += k
+    payload = rec.tobytes()
+    header = _CHUNK_HEADER.pack(CHUNK_MAGIC, n, zlib.crc32(payload) & 0xFFFFFFFF,
+                                pending[0][0], pending[-1][0])
+    os.write(self._fd, header + payload)
+    self.frames += n
+    self.chunks += 1
+
+  def close(self):
+    if self._running:
+      self._running = False
+      # a dead writer never drains a full queue
+      while self._thread.is_alive():
+        try:
+          self._queue.put(None, timeout=0.1)
+          break
+        except queue.Full:
+          pass
+      self._thread.join()
+    if self.error is not None:
+      raise self.error
+
+
+def _valid_length(fn):
+  # bytes of fn up to the end of the last intact chunk
+  end = _FILE_HEADER.size
+  for _, _, chunk_end in _iter_chunks(fn):
+    end = chunk_end
+  return end
+
+
+def _open_for_append(fn):
+  size = os.path.getsize(fn) if os.path.exists(fn) else 0
+  if size > 0:
+    with open(fn, "r+b") as f:
+      # a torn file header means nothing was recorded, start over
+      f.truncate(_valid_length(fn) if size >= _FILE_HEADER.size else 0)
+  fd = os.open(fn, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+  if os.fstat(fd).st_size == 0:
+    os.write(fd, _FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION))
+    os.fsync(fd)
+  return fd
+
+
+def _iter_chunks(fn):
+  with open(fn, "rb") as f:
+    header = f.read(_FILE_HEADER.size)
+    if len(header) < _FILE_HEADER.size:
+      # torn file header, an empty recording
+      return
+    magic, version = _FILE_HEADER.unpack(header)
+    assert magic == FILE_MAGIC, "%s is not a panda CAN recording" % fn
+    assert version == FILE_VERSION
+    off = _FILE_HEADER.size
+    while True:
+      header = f.read(_CHUNK_HEADER.size)
+      if len(header) < _CHUNK_HEADER.size:
+        return
+      magic, n, crc, _, _ = _CHUNK_HEADER.unpack(header)
+      payload = f.read(n * RECORD_DTYPE.itemsize)
+      if magic != CHUNK_MAGIC or len(payload) != n * RECORD_DTYPE.itemsize or \
+         zlib.crc32(payload) & 0xFFFFFFFF != crc:
+        # torn or corrupt tail, everything before it is good
+        return
+      off += len(header) + len(payload)
+      yield header, payload, off
+
+
+def read_recording(fn):
+  """Yields (host times float64[n], raw frames bytes) per intact chunk.
+
+  The raw frames parse with parse_can_buffer / parse_can_buffer_columnar.
+  """
+  for _, payload, _ in _iter_chunks(fn):
+    rec = np.frombuffer(payload, dtype=RECORD_DTYPE)
+    yield rec["t"], rec["frame"].tobytes()
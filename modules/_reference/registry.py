@@ -0,0 +1,287 @@
+# one USB context per process and a cache of the pandas on it, kept current by hotplug
+import collections
+import select
+import threading
+import time
+
+import usb1
+
+from .clock import monotonic
+
+PANDA_VID = 0xbbaa
+PANDA_PIDS = (0xddcc, 0xddee) # 0xddee = bootstub
+DFU_VID = 0x0483
+DFU_PIDS = (0xdf11,)
+
+CAN_IN_ENDPOINT = usb1.ENDPOINT_IN | 1 # 0x81
+CAN_OUT_ENDPOINT = usb1.ENDPOINT_OUT | 3
+
+_KNOWN = {PANDA_VID: PANDA_PIDS, DFU_VID: DFU_PIDS}
+
+
+class UsbDeviceInfo(object):
+  """Cached descriptor fields of one device, keyed by (bus, address)."""
+  __slots__ = ("bus", "address", "vid", "pid", "bcd", "serial", "device", "error")
+
+  def __init__(self, device):
+    self.bus = device.getBusNumber()
+    self.address = device.getDeviceAddress()
+    self.vid = device.getVendorID()
+    self.pid = device.getProductID()
+    self.bcd = device.getbcdDevice()
+    self.serial = None
+    self.device = device
+    self.error = None
+
+  @property
+  def key(self):
+    return (self.bus, self.address)
+
+  def matches(self, vid, pids, serial=None):
+    return self.vid == vid and self.pid in pids and self.serial is not None and \
+      (serial is None or self.serial == serial)
+
+
+class _LoopPollFDs(object):
+  # libusb's poll fds as readers/writers of one asyncio loop, shared by its users
+  def __init__(self, loop, context):
+    self.loop = loop
+    self.context = context
+    self.refs = 1
+    self.fds = {}
+
+  def add(self, fd, events):
+    # loop thread only
+    if not self.refs:
+      return
+    self.remove(fd)
+    if events & select.POLLIN:
+      self.loop.add_reader(fd, self.handle_events)
+    if events & select.POLLOUT:
+      self.loop.add_writer(fd, self.handle_events)
+    self.fds[fd] = events
+
+  def remove(self, fd):
+    events = self.fds.pop(fd, 0)
+    if events & select.POLLIN:
+      self.loop.remove_reader(fd)
+    if events & select.POLLOUT:
+      self.loop.remove_writer(fd)
+
+  def handle_events(self):
+    self.context.handleEventsTimeout(0)
+
+  def clear(self):
+    for fd in list(self.fds):
+      self.remove(fd)
+
+
+class DeviceRegistry(object):
+  """Process wide USB context and device cache.
+
+  With hotplug support, libusb reports arrivals and removals to a callback
+  and an event thread reads the serials of new pandas (the callback may not
+  do synchronous I/O). Without it, each lookup rescans the bus but only
+  reads string descriptors of devices it hasn't seen before.
+
+    registry = get_registry()
+    info = registry.wait_for(PANDA_VID, PANDA_PIDS, serial, timeout=10.)
+  """
+
+  def __init__(self, context=None, poll_interval=0.1):
+    self.context = context or usb1.USBContext()
+    self.poll_interval = poll_interval
+    self.hotplug = bool(self.context.hasCapability(usb1.CAP_HAS_HOTPLUG))
+    self._devices = {}
+    self._unread = collections.deque()
+    self._cond = threading.Condition()
+    self._thread = None
+    self._running = False
+    self._callback = None
+    self._loops = {}
+    self._loops_lock = threading.Lock()
+    self.arrivals = 0
+    self.removals = 0
+    self.scans = 0
+
+  def start(self):
+    if self.hotplug and self._callback is None:
+      # ENUMERATE runs the callback for every device already plugged in
+      self._callback = self.context.hotplugRegisterCallback(self._on_hotplug)
+      self._read_serials()
+      self._running = True
+      self._thread = threading.Thread(target=self._run, name="panda-usb-events")
+      self._thread.daemon = True
+      self._thread.start()
+    elif not self.hotplug:
+      self.rescan()
+    return self
+
+  def stop(self):
+    self._running = False
+    if self._callback is not None:
+      self.context.hotplugDeregisterCallback(self._callback)
+      self._callback = None
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+  def watch_pollfds(self, loop):
+    """Has an asyncio loop handle libusb events when the poll fds are ready.
+
+    The context only takes one set of fd notifiers, so the registry owns
+    them and forwards to every watching loop. Calls are counted per loop,
+    each needs a matching unwatch_pollfds() on the loop thread.
+    """
+    with self._loops_lock:
+      watch = self._loops.get(loop)
+      if watch is not None:
+        watch.refs += 1
+        return
+      watch = self._loops[loop] = _LoopPollFDs(loop, self.context)
+      if len(self._loops) == 1:
+        self.context.setPollFDNotifiers(self._on_fd_added, self._on_fd_removed)
+      fds = self.context.getPollFDList()
+    for fd, events in fds:
+      watch.add(fd, events)
+
+  def unwatch_pollfds(self, loop):
+    with self._loops_lock:
+      watch = self._loops[loop]
+      watch.refs -= 1
+      if watch.refs:
+        return
+      del self._loops[loop]
+      if not self._loops:
+        self.context.setPollFDNotifiers()
+    watch.clear()
+
+  def _on_fd_added(self, fd, events, _user_data=None):
+    with self._loops_lock:
+      watches = list(self._loops.values())
+    for watch in watches:
+      watch.loop.call_soon_threadsafe(watch.add, fd, events)
+
+  def _on_fd_removed(self, fd, _user_data=None):
+    with self._loops_lock:
+      watches = list(self._loops.values())
+    for watch in watches:
+      watch.loop.call_soon_threadsafe(watch.remove, fd)
+
+  def _on_hotplug(self, context, device, event):
+    # libusb event context, descriptor reads only
+    with self._cond:
+      key = (device.getBusNumber(), device.getDeviceAddress())
+      if event == usb1.HOTPLUG_EVENT_DEVICE_ARRIVED:
+        self._add(UsbDeviceInfo(device))
+      elif self._devices.pop(key, None) is not None:
+        self.removals += 1
+      self._cond.notify_all()
+    return False
+
+  def _add(self, info):
+    # caller holds the lock
+    self._devices[info.key] = info
+    self.arrivals += 1
+    if info.pid in _KNOWN.get(info.vid, ()):
+      self._unread.append(info)
+
+  def _run(self):
+    while self._running:
+      try:
+        self.context.handleEventsTimeout(self.poll_interval)
+        self._read_serials()
+      except usb1.USBError:
+        time.sleep(self.poll_interval)
+
+  def _read_serials(self):
+    while True:
+      with self._cond:
+        if not self._unread:
+          return
+        info = self._unread.popleft()
+      try:
+        if info.vid == DFU_VID:
+          serial = info.device._getASCIIStringDescriptor(3)
+        else:
+          serial = info.device.getSerialNumber()
+      except Exception as e:
+        # typically no permission, it stays unlisted
+        serial = None
+        info.error = e
+      with self._cond:
+        info.serial = serial
+        self._cond.notify_all()
+
+  def rescan(self):
+    """Syncs the cache with the bus, only needed without hotplug."""
+    with self._cond:
+      seen = set()
+      for device in self.context.getDeviceList(skip_on_error=True):
+        key = (device.getBusNumber(), device.getDeviceAddress())
+        seen.add(key)
+        if key not in self._devices:
+          self._add(UsbDeviceInfo(device))
+      for key in set(self._devices) - seen:
+        del self._devices[key]
+        self.removals += 1
+      self.scans += 1
+    self._read_serials()
+
+  def forget(self, info):
+    """Drops a cached device that turned out to be gone."""
+    with self._cond:
+      if self._devices.get(info.key) is info:
+        del self._devices[info.key]
+        self.removals += 1
+
+  def devices(self):
+    with self._cond:
+      return list(self._devices.values())
+
+  def _match(self, vid, pids, serial):
+    # caller holds the lock
+    return [info for info in self._devices.values() if info.matches(vid, pids, serial)]
+
+  def find(self, vid, pids, serial=None):
+    """Cached devices matching vid, one of pids and (if given) serial."""
+    if not self.hotplug:
+      self.rescan()
+    with self._cond:
+      return self._match(vid, pids, serial)
+
+  def wait_for(self, vid, pids, serial=None, timeout=None):
+    """Returns the first matching device, or None after timeout seconds."""
+    end = None if timeout is None else monotonic() + timeout
+    while True:
+      if self.hotplug:
+        # check and wait under one lock hold, the hotplug callback and serial
+        # reads notify under it too, so no arrival slips in between
+        with self._cond:
+          found = self._match(vid, pids, serial)
+          remaining = None if end is None else end - monotonic()
+          if not found and (remaining is None or remaining > 0):
+            self._cond.wait(remaining)
+            found = self._match(vid, pids, serial)
+      else:
+        found = self.find(vid, pids, serial)
+      if found:
+        return found[0]
+      remaining = None if end is None else end - monotonic()
+      if remaining is not None and remaining <= 0:
+        return None
+      if not self.hotplug:
+        time.sleep(self.poll_interval if remaining is None else min(remaining, self.poll_interval))
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+  """The process wide DeviceRegistry, started on first use."""
+  global _registry
+  with _registry_lock:
+    if _registry is None:
+      _registry = DeviceRegistry().start()
+    return _registry
@@ -0,0 +1,186 @@
+# time accurate replay of recorded CAN traffic through can_send_many
+import threading
+
+import numpy as np
+
+from .clock import monotonic
+from .columnar import CanColumns, parse_can_buffer_columnar
+
+
+def _chunks(source, t0, t1):
+  # (t, CanColumns) from a CanLogReader, read_recording() or any such iterable
+  if hasattr(source, "query"):
+    chunks = source.query(t0=t0, t1=t1)
+  else:
+    chunks = source
+  for t, cols in chunks:
+    if not isinstance(cols, CanColumns):
+      cols = parse_can_buffer_columnar(cols)
+    t = np.broadcast_to(np.asarray(t, dtype=np.float64), (len(cols),))
+    if t0 is not None or t1 is not None:
+      keep = np.ones(len(cols), dtype=bool)
+      if t0 is not None:
+        keep &= t >= t0
+      if t1 is not None:
+        keep &= t <= t1
+      t, cols = t[keep], cols[keep]
+    yield t, cols
+
+
+class CanReplay(object):
+  """Plays a recorded drive back onto the bus at `speed` times real time.
+
+  Each frame is due at start + (t - t_first) / speed on a monotonic clock
+  that is never rebased, so after a stall the late frames go out at once
+  and the replay is back on schedule. Frames due within `slot` seconds of
+  each other are sent in one can_send_many of up to max_transfer frames.
+  speed=None sends as fast as the panda takes them.
+
+    log = CanLogReader("drive.canlog")
+    replay = CanReplay(panda, log, speed=10., bus_map={0: 1})
+    replay.run()
+    print(replay.stats())
+
+  Args:
+    source: CanLogReader, read_recording(fn) or an iterable of (t, frames)
+    bus_map (dict): recorded bus -> bus to send on, None drops the bus
+    can_filter (CanFilter): only replay frames it accepts
+    include_tx (bool): also replay frames the recording panda sent itself
+  """
+
+  def __init__(self, panda, source, speed=1.0, bus_map=None, can_filter=None, t0=None, t1=None,
+               slot=0.001, max_transfer=0x100, include_tx=False):
+    assert speed is None or speed > 0
+    self.panda = panda
+    self.source = source
+    self.speed = speed
+    self.can_filter = can_filter
+    self.t0 = t0
+    self.t1 = t1
+    self.slot = slot
+    self.max_transfer = max_transfer
+    self.include_tx = include_tx
+
+    # -1 drops the bus
+    self._bus_map = np.arange(0x100, dtype=np.int16)
+    for src, dst in (bus_map or {}).items():
+      self._bus_map[src] = -1 if dst is None else dst
+
+    self._stop = threading.Event()
+    self._thread = None
+    self._reset()
+
+  def _reset(self):
+    self.error = None
+    self.frames = 0
+    self.filtered = 0
+    self.transfers = 0
+    self.late_frames = 0
+    self.stalls = 0
+    self._err_sum = 0.0
+    self._err_sq = 0.0
+    self.max_error = 0.0
+    self.duration = None
+
+  def _prepare(self, cols):
+    # filtered and remapped (address, bus, length, data)
+    keep = np.ones(len(cols), dtype=bool)
+    if not self.include_tx:
+      keep &= cols.src < 0x80
+    if self.can_filter is not None:
+      keep &= self.can_filter.mask(cols)
+    bus = self._bus_map[cols.src & 0x7F]
+    keep &= bus >= 0
+    self.filtered += len(cols) - int(keep.sum())
+    return keep, bus
+
+  def _send(self, cols, bus, lo, hi):
+    arr = [[address, None, data[:length].tobytes(), b] for address, b, length, data in
+           zip(cols.address[lo:hi].tolist(), bus[lo:hi].tolist(), cols.length[lo:hi].tolist(),
+               cols.data[lo:hi])]
+    self.panda.can_send_many(arr)
+    self.transfers += 1
+    self.frames += hi - lo
+
+  def _record(self, due, sent):
+    err = sent - due
+    self._err_sum += float(err.sum())
+    self._err_sq += float((err * err).sum())
+    self.max_error = max(self.max_error, float(np.abs(err).max()))
+    self.late_frames += int((err > self.slot).sum())
+
+  def run(self):
+    """Replays the whole source in the calling thread."""
+    self._reset()
+    self._stop.clear()
+    start = None
+    t_first = None
+    for t, cols in _chunks(self.source, self.t0, self.t1):
+      if self._stop.is_set():
+        break
+      keep, bus = self._prepare(cols)
+      t, cols, bus = t[keep], cols[keep], bus[keep]
+      if not len(t):
+        continue
+      if start is None:
+        start = monotonic()
+        t_first = float(t[0])
+
+      if self.speed is None:
+        for lo in range(0, len(t), self.max_transfer):
+          self._send(cols, bus, lo, min(lo + self.max_transfer, len(t)))
+        continue
+
+      due = start + (t - t_first) / self.speed
+      i = 0
+      while i < len(t) and not self._stop.is_set():
+        wait = due[i] - monotonic()
+        if wait > 0:
+          self._stop.wait(wait)
+          if self._stop.is_set():
+            break
+        elif wait < -self.slot:
+          self.stalls += 1
+        # everything due by the end of this slot goes out in one write
+        j = int(np.searchsorted(due, monotonic() + self.slot, side="right"))
+        j = min(max(j, i + 1), i + self.max_transfer)
+        self._send(cols, bus, i, j)
+        self._record(due[i:j], monotonic())
+        i = j
+    if start is not None:
+      self.duration = monotonic() - start
+
+  def _run(self):
+    try:
+      self.run()
+    except Exception as e:
+      self.error = e
+
+  def start(self):
+    if self._thread is None:
+      self._stop.clear()
+      self._thread = threading.Thread(target=self._run, name="panda-can-replay")
+      self._thread.daemon = True
+      self._thread.start()
+    return self
+
+  def stop(self):
+    self._stop.set()
+    self.join()
+
+  def join(self, timeout=None):
+    if self._thread is not None:
+      self._thread.join(timeout)
+      if not self._thread.is_alive():
+        self._thread = None
+    if self.error is not None:
+      raise self.error
+
+  def stats(self):
+    """Replayed frames and timing error (s, sent - due) over the replay."""
+    n = self.frames if self.speed is not None else 0
+    mean = self._err_sum / n if n else 0.0
+    var = max(self._err_sq / n - mean * mean, 0.0) if n else 0.0
+    return {"frames": self.frames, "filtered": self.filtered, "transfers": self.transfers,
+            "late_frames": self.late_frames, "stalls": self.stalls, "error_mean": mean,
+            "error_std": var ** 0.5, "error_max": self.max_error, "duration": self.duration}
@@ -0,0 +1,176 @@
+# retry policy and libusb error classification for the USB bulk paths
+import usb1
+
+# worth retrying on the same handle
+TRANSIENT = "transient"
+# the handle is gone, only a reconnect can help
+DISCONNECT = "disconnect"
+# retrying won't help (permissions, interface claimed elsewhere, bad request)
+FATAL = "fatal"
+
+_CLASSES = (
+  (TRANSIENT, (usb1.USBErrorIO, usb1.USBErrorOverflow, usb1.USBErrorPipe,
+               usb1.USBErrorTimeout, usb1.USBErrorInterrupted)),
+  (DISCONNECT, (usb1.USBErrorNoDevice, usb1.USBErrorNotFound)),
+)
+
+
+def classify_usb_error(e):
+  for kind, errors in _CLASSES:
+    if isinstance(e, errors):
+      return kind
+  return FATAL
+
+
+def transfer_error(status):
+  # the USBError a synchronous call would have raised for an async transfer status
+  return {
+    usb1.TRANSFER_ERROR: usb1.USBErrorIO,
+    usb1.TRANSFER_OVERFLOW: usb1.USBErrorOverflow,
+    usb1.TRANSFER_TIMED_OUT: usb1.USBErrorTimeout,
+    usb1.TRANSFER_STALL: usb1.USBErrorPipe,
+    usb1.TRANSFER_NO_DEVICE: usb1.USBErrorNoDevice,
+    usb1.TRANSFER_CANCELLED: usb1.USBErrorInterrupted,
+  }.get(status, usb1.USBErrorOther)()
+
+
+class RetryPolicy(object):
+  """How Panda retries failed bulk transfers.
+
+  Transient errors are retried up to max_attempts times with exponential
+  backoff (backoff, 2*backoff, ... capped at max_backoff seconds). After
+  that, or on a disconnect, on_exhausted decides: RAISE re-raises the last
+  USB error, RECONNECT reconnects to the same serial (for up to
+  reconnect_timeout seconds) and retries once more before raising.
+  """
+
+  RAISE = "raise"
+  RECONNECT = "reconnect"
+  # what RetryState.failed tells the caller to do, besides RAISE and RECONNECT
+  RETRY = "retry"
+
+  def __init__(self, max_attempts=10, backoff=0.001, max_backoff=0.25,
+               on_exhausted=RAISE, reconnect_timeout=5.0):
+    assert on_exhausted in (self.RAISE, self.RECONNECT)
+    self.max_attempts = max_attempts
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.on_exhausted = on_exhausted
+    self.reconnect_timeout = reconnect_timeout
+
+  def delay(self, attempt):
+    # sleep before retry number `attempt` (1 based)
+    return min(self.backoff * (2 ** (attempt - 1)), self.max_backoff)
+
+  def tracker(self, stats, counter, msg):
+    """A RetryState for one transfer path, see Panda._usb_retry."""
+    return RetryState(self, stats, counter, msg)
+
+
+class RetryState(object):
+  """Consecutive failures of one transfer path under a RetryPolicy.
+
+  failed(e) does the bookkeeping (the can_stats error and retry counters,
+  the RETRYING, RECONNECTING and GIVING UP messages) and returns what the
+  caller does next: RETRY after delay() seconds, RECONNECT and retry, or
+  RAISE. One reconnect is allowed until the path succeeds again.
+
+    retry = panda.retry_policy.tracker(panda.can_stats, "recv_retries", "CAN: BAD RECV")
+  """
+
+  def __init__(self, policy, stats, counter, msg):
+    self.policy = policy
+    self.stats = stats
+    # name of the stats field counting retries
+    self.counter = counter
+    self.msg = msg
+    self.attempt = 0
+    self.reconnected = False
+
+  def failed(self, e):
+    policy = self.policy
+    self.stats.record_error(e)
+    kind = classify_usb_error(e)
+    if kind == FATAL:
+      return RetryPolicy.RAISE
+    self.attempt += 1
+    if kind == DISCONNECT or self.attempt >= policy.max_attempts:
+      if policy.on_exhausted != RetryPolicy.RECONNECT or self.reconnected:
+        print("%s, GIVING UP after %d attempts: %s" % (self.msg, self.attempt, e))
+        return RetryPolicy.RAISE
+      print("%s, RECONNECTING: %s" % (self.msg, e))
+      self.reconnected = True
+      self.attempt = 0
+      return RetryPolicy.RECONNECT
+    self.stats.record_retry(self.counter)
+    if self.attempt == 1:
+      print("%s, RETRYING" % self.msg)
+    return RetryPolicy.RETRY
+
+  def delay(self):
+    # before the retry failed() just asked for
+    return self.policy.delay(self.attempt)
+
+
+def _after_reconnect(name):
+  # a DetachedHandle transfer: waits for the reconnect, then goes to the new handle
+  def call(self, *args, **kwargs):
+    panda = self.panda
+    if panda is not None:
+      with panda._reconnect_lock:
+        handle = panda._handle
+      if not panda._detached():
+        return getattr(handle, name)(*args, **kwargs)
+    raise usb1.USBErrorNoDevice()
+  return call
+
+
+class DetachedHandle(object):
+  # stands in for the handle while Panda.reconnect runs, so concurrent
+  # users wait for the reconnect instead of crashing, and see a disconnect
+  # only if it failed. getTransfer never blocks, async users follow
+  # panda._generation instead
+  def __init__(self, panda=None):
+    self.panda = panda
+
+  def _gone(self, *args, **kwargs):
+    raise usb1.USBErrorNoDevice()
+
+  getTransfer = _gone
+  controlRead = _after_reconnect("controlRead")
+  controlWrite = _after_reconnect("controlWrite")
+  bulkRead = _after_reconnect("bulkRead")
+  bulkWrite = _after_reconnect("bulkWrite")
+
+  def close(self):
+    pass
+
+
+class ReconnectingHandle(object):
+  """USB handle wrapper for Panda.enable_auto_reconnect.
+
+  Transfers that fail because the device went away call
+  panda.reconnect(generation) and are retried once on the new handle.
+  Concurrent failures of the same handle share one reconnect.
+  """
+
+  _TRANSFERS = ("controlRead", "controlWrite", "bulkRead", "bulkWrite")
+
+  def __init__(self, panda, handle, generation):
+    self.panda = panda
+    self.handle = handle
+    self.generation = generation
+
+  def __getattr__(self, name):
+    attr = getattr(self.handle, name)
+    if name not in self._TRANSFERS:
+      return attr
+    def call(*args, **kwargs):
+      try:
+        return attr(*args, **kwargs)
+      except usb1.USBError as e:
+        if classify_usb_error(e) != DISCONNECT:
+          raise
+        self.panda.reconnect(self.generation)
+        return getattr(self.panda._handle, name)(*args, **kwargs)
+    return call
@@ -0,0 +1,189 @@
+# drift free periodic CAN transmit, due messages coalesced into one bulk write
+import math
+import threading
+
+from .clock import monotonic
+
+
+class PeriodicMessage(object):
+  """One cyclic message owned by a CanScheduler.
+
+  Send times are base + phase + k*period, so errors don't accumulate. If
+  hook is set it is called as hook(msg, dat, counter) at send time and
+  returns the payload to send, e.g. to fill in a rolling counter and
+  checksum.
+  """
+  __slots__ = ("addr", "bus", "dat", "period", "phase", "hook", "counter",
+               "_k", "_base", "next_due", "last_sent", "sent", "missed",
+               "_period_sum", "_jitter_sum", "_jitter_sq", "max_jitter")
+
+  def __init__(self, addr, dat, bus, period, phase=0.0, hook=None):
+    assert period > 0
+    self.addr = addr
+    self.bus = bus
+    self.dat = dat
+    self.period = period
+    self.phase = phase
+    self.hook = hook
+    self.counter = 0
+    self._k = 0
+    self._base = None
+    self.next_due = None
+    self.last_sent = None
+    self.sent = 0
+    self.missed = 0
+    self._period_sum = 0.0
+    self._jitter_sum = 0.0
+    self._jitter_sq = 0.0
+    self.max_jitter = 0.0
+
+  def _schedule(self, base):
+    self._base = base + self.phase
+    self._k = 0
+    self.next_due = self._base
+
+  def _claim(self, now):
+    # takes the due slot, returns (its time, counter) for the send
+    due, counter = self.next_due, self.counter
+    self.counter += 1
+
+    # next slot after now, skipping (and counting) slots we were too late for
+    k = int(math.floor((now - self._base) / self.period)) + 1
+    k = max(k, self._k + 1)
+    self.missed += k - self._k - 1
+    self._k = k
+    self.next_due = self._base + k * self.period
+    return due, counter
+
+  def _sent(self, now, due):
+    jitter = now - due
+    if self.last_sent is not None:
+      self._period_sum += now - self.last_sent
+    self.last_sent = now
+    self.sent += 1
+    self._jitter_sum += jitter
+    self._jitter_sq += jitter * jitter
+    self.max_jitter = max(self.max_jitter, abs(jitter))
+
+  def stats(self):
+    n = self.sent
+    mean = self._jitter_sum / n if n else 0.0
+    var = max(self._jitter_sq / n - mean * mean, 0.0) if n else 0.0
+    return {"sent": n, "missed": self.missed,
+            "period": self._period_sum / (n - 1) if n > 1 else None,
+            "jitter_mean": mean, "jitter_std": math.sqrt(var), "jitter_max": self.max_jitter}
+
+
+class CanScheduler(object):
+  """Sends a set of periodic messages from one thread.
+
+    sched = CanScheduler(panda)
+    msg = sched.add(0x1d0, b"\\x00"*8, 0, period=0.01)
+    sched.start()
+    sched.update(msg, new_dat)
+
+  All messages due at the same tick go out in a single can_send_many.
+  """
+
+  def __init__(self, panda, lateness=0.0005):
+    self.panda = panda
+    # messages due within this window of each other share a write
+    self.lateness = lateness
+    self._messages = []
+    self._lock = threading.Lock()
+    self._wake = threading.Event()
+    self._thread = None
+    self._running = False
+    self._base = None
+    self.writes = 0
+    self.error = None
+
+  def add(self, addr, dat, bus, period, phase=0.0, hook=None):
+    msg = PeriodicMessage(addr, dat, bus, period, phase, hook)
+    with self._lock:
+      if self._base is not None:
+        msg._schedule(monotonic())
+      self._messages.append(msg)
+    self._wake.set()
+    return msg
+
+  def remove(self, msg):
+    with self._lock:
+      self._messages.remove(msg)
+
+  def update(self, msg, dat):
+    # replaces the payload atomically, the next send uses it
+    with self._lock:
+      msg.dat = dat
+
+  def _due(self, now):
+    # caller holds the lock: claims the due slots, hooks run after it's released
+    due = []
+    for msg in self._messages:
+      if msg.next_due <= now + self.lateness:
+        t, counter = msg._claim(now)
+        due.append((msg, msg.dat, t, counter))
+    return due
+
+  def tick(self, now=None):
+    """Sends everything that is due, returns seconds until the next message."""
+    if now is None:
+      now = monotonic()
+    with self._lock:
+      if self._base is None:
+        self._base = now
+        for msg in self._messages:
+          msg._schedule(now)
+      due = self._due(now)
+    if due:
+      # hooks may call update(), add() or remove(), so no lock here
+      frames = []
+      for msg, dat, _, counter in due:
+        if msg.hook is not None:
+          dat = msg.hook(msg, dat, counter)
+        frames.append([msg.addr, None, dat, msg.bus])
+      self.panda.can_send_many(frames)
+      self.writes += 1
+      sent = monotonic()
+      with self._lock:
+        for msg, _, t, _ in due:
+          msg._sent(sent, t)
+    with self._lock:
+      if not self._messages:
+        return None
+      return max(min(msg.next_due for msg in self._messages) - monotonic(), 0.0)
+
+  def _run(self):
+    try:
+      while self._running:
+        self._wake.clear()
+        wait = self.tick()
+        if wait is None:
+          self._wake.wait(0.1)
+        elif wait > 0:
+          self._wake.wait(wait)
+    except Exception as e:
+      self.error = e
+      self._running = False
+
+  def start(self):
+    if self._thread is None:
+      self._running = True
+      self._thread = threading.Thread(target=self._run, name="panda-can-tx-sched")
+      self._thread.daemon = True
+      self._thread.start()
+    return self
+
+  def stop(self):
+    self._running = False
+    self._wake.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+    with self._lock:
+      self._base = None
+
+  def stats(self):
+    """Achieved period and jitter (s, actual - scheduled) per message."""
+    with self._lock:
+      return dict(((msg.bus, msg.addr), msg.stats()) for msg in self._messages)
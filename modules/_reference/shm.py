@@ -0,0 +1,313 @@
+# shared memory ring of parsed CAN frames, one writer and many reader processes
+import errno
+import mmap
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from .clock import monotonic
+from .columnar import CanColumns, parse_can_buffer_columnar
+
+SHM_MAGIC = b"PANDASHM"
+SHM_VERSION = 2
+
+# write_seq and claim_seq form a seqlock: the writer raises claim_seq to the
+# end of a write before copying the frames and publishes write_seq after
+_HEADER_DTYPE = np.dtype([("magic", "S8"), ("version", "<u4"), ("capacity", "<u4"),
+                          ("max_readers", "<u4"), ("writer_pid", "<u4"), ("write_seq", "<u8"),
+                          ("claim_seq", "<u8"), ("pad", "u1", (24,))])
+_READER_DTYPE = np.dtype([("pid", "<u4"), ("pad", "<u4"), ("cursor", "<u8"),
+                          ("dropped", "<u8"), ("reads", "<u8")])
+# one parsed frame and the host time of the read it came from
+SHM_FRAME_DTYPE = np.dtype([("t", "<f8"), ("address", "<u4"), ("bus_time", "<u2"),
+                            ("src", "u1"), ("length", "u1"), ("data", "u1", (8,))])
+
+
+def shm_path(name):
+  base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+  return os.path.join(base, name)
+
+
+class _Ring(object):
+  # numpy views of the header, reader table and frame ring in a mapped file
+  def __init__(self, fd, size):
+    self.mm = mmap.mmap(fd, size)
+    self.header = np.frombuffer(self.mm, dtype=_HEADER_DTYPE, count=1)[0]
+
+  def layout(self, capacity, max_readers):
+    off = _HEADER_DTYPE.itemsize
+    self.readers = np.frombuffer(self.mm, dtype=_READER_DTYPE, count=max_readers, offset=off)
+    off += _READER_DTYPE.itemsize * max_readers
+    self.frames = np.frombuffer(self.mm, dtype=SHM_FRAME_DTYPE, count=capacity, offset=off)
+
+  @staticmethod
+  def size(capacity, max_readers):
+    return (_HEADER_DTYPE.itemsize + _READER_DTYPE.itemsize * max_readers +
+            SHM_FRAME_DTYPE.itemsize * capacity)
+
+  def close(self):
+    self.header = self.readers = self.frames = None
+    try:
+      self.mm.close()
+    except BufferError:
+      # views handed out by read() are still alive, the mapping goes with them
+      pass
+
+
+class CanShmWriter(object):
+  """Publishes parsed frames into a shared memory ring.
+
+  The writer never waits for readers. Each reader keeps its own cursor in
+  the shared reader table, and one that falls more than a ring behind
+  skips ahead and counts what it missed.
+
+    shm = CanShmWriter("panda-can")
+    panda.start_can_receiver().add_listener(shm.write_batch)
+
+  The ring is created with mode (owner only by default). Readers register
+  their cursors in it, so readers of other users need write access too,
+  e.g. mode=0o660 with a shared group.
+  """
+
+  def __init__(self, name="panda-can", capacity=1 << 16, max_readers=16, mode=0o600):
+    self.path = shm_path(name)
+    self.capacity = capacity
+    self.mode = mode
+    size = _Ring.size(capacity, max_readers)
+    self._ring = self._reuse(size, capacity, max_readers)
+    if self._ring is None:
+      self._ring = self._create(size, capacity, max_readers)
+    header = self._ring.header
+    header["writer_pid"] = os.getpid()
+    self._seq = int(header["write_seq"])
+    # a writer that died mid write never published those frames
+    header["claim_seq"] = self._seq
+    self.frames = 0
+
+  def _reuse(self, size, capacity, max_readers):
+    # attached readers keep their cursors if the ring left behind matches
+    try:
+      fd = os.open(self.path, os.O_RDWR)
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+      return None
+    try:
+      found = os.fstat(fd).st_size
+      if found < _HEADER_DTYPE.itemsize:
+        return None
+      ring = _Ring(fd, found)
+    finally:
+      os.close(fd)
+    header = ring.header
+    if bytes(header["magic"]) != SHM_MAGIC or header["version"] != SHM_VERSION:
+      ring.close()
+      return None
+    # a live writer keeps its ring whatever its layout, never replace it
+    pid = int(header["writer_pid"])
+    if pid != 0 and _alive(pid):
+      ring.close()
+      raise RuntimeError("%s already has a writer (pid %d)" % (self.path, pid))
+    if found != size or header["capacity"] != capacity or header["max_readers"] != max_readers:
+      ring.close()
+      return None
+    ring.layout(capacity, max_readers)
+    return ring
+
+  def _create(self, size, capacity, max_readers):
+    # never truncate a mapped ring, readers touching cut off pages get
+    # SIGBUS; they keep the unlinked one until they reopen
+    try:
+      os.unlink(self.path)
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+    fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL, self.mode)
+    try:
+      os.ftruncate(fd, size)
+      ring = _Ring(fd, size)
+    finally:
+      os.close(fd)
+    ring.layout(capacity, max_readers)
+    header = ring.header
+    header["version"] = SHM_VERSION
+    header["capacity"] = capacity
+    header["max_readers"] = max_readers
+    header["write_seq"] = 0
+    header["claim_seq"] = 0
+    # readers check the magic last
+    header["magic"] = SHM_MAGIC
+    return ring
+
+  def write(self, cols, t):
+    """Args:
+      cols (CanColumns): frames to publish
+      t (float or float array): host time of the read, or one per frame
+    """
+    n = len(cols)
+    if n == 0:
+      return
+    t = np.broadcast_to(np.asarray(t, dtype=np.float64), (n,))
+    if n > self.capacity:
+      cols, t = cols[n - self.capacity:], t[n - self.capacity:]
+      self._seq += n - self.capacity
+      n = self.capacity
+    # readers' intact() fails for slots from here on before they change
+    self._ring.header["claim_seq"] = self._seq + n
+    ring = self._ring.frames
+    pos = self._seq % self.capacity
+    done = 0
+    while done < n:
+      k = min(n - done, self.capacity - pos)
+      dst = ring[pos:pos+k]
+      dst["t"] = t[done:done+k]
+      dst["address"] = cols.address[done:done+k]
+      dst["bus_time"] = cols.bus_time[done:done+k]
+      dst["src"] = cols.src[done:done+k]
+      dst["length"] = cols.length[done:done+k]
+      dst["data"] = cols.data[done:done+k]
+      done += k
+      pos = 0
+    # publish only once the frames are in place
+    self._seq += n
+    self._ring.header["write_seq"] = self._seq
+    self.frames += n
+
+  def write_batch(self, batch):
+    self.write(parse_can_buffer_columnar(batch.buffer), batch.t)
+
+  def readers(self):
+    """Lag and drop counts of the registered readers."""
+    ret = []
+    for r in self._ring.readers:
+      pid = int(r["pid"])
+      if pid:
+        ret.append({"pid": pid, "lag": self._seq - int(r["cursor"]), "dropped": int(r["dropped"]),
+                    "reads": int(r["reads"]), "alive": _alive(pid)})
+    return ret
+
+  def close(self, unlink=True):
+    self._ring.header["writer_pid"] = 0
+    self._ring.close()
+    if unlink:
+      os.unlink(self.path)
+
+
+class CanShmReader(object):
+  """One consumer of a CanShmWriter ring, in any local process.
+
+  read() returns numpy views straight into shared memory. They stay valid
+  until the writer laps them, which `slack` frames of headroom (and
+  intact()) guard against; copy what needs to be kept.
+
+    shm = CanShmReader("panda-can")
+    while True:
+      t, cols = shm.recv(timeout=1.0)
+  """
+
+  def __init__(self, name="panda-can", slack=None, poll_interval=0.001, latest=True):
+    self.path = shm_path(name)
+    fd = os.open(self.path, os.O_RDWR)
+    try:
+      size = os.fstat(fd).st_size
+      self._ring = _Ring(fd, size)
+    finally:
+      os.close(fd)
+    header = self._ring.header
+    assert bytes(header["magic"]) == SHM_MAGIC, "%s is not a panda CAN ring" % self.path
+    assert header["version"] == SHM_VERSION
+    self.capacity = int(header["capacity"])
+    self._ring.layout(self.capacity, int(header["max_readers"]))
+    # a reader that lags this close to a full ring is skipped ahead
+    self.slack = self.capacity // 4 if slack is None else slack
+    self.poll_interval = poll_interval
+    self._slot = self._register(int(header["write_seq"]) if latest else 0)
+    self._last = None
+
+  def _register(self, cursor):
+    # posix only, imported here so the package still imports on windows
+    import fcntl
+    with open(self.path, "rb") as f:
+      fcntl.flock(f, fcntl.LOCK_EX)
+      try:
+        for r in self._ring.readers:
+          pid = int(r["pid"])
+          if pid == 0 or not _alive(pid):
+            r["cursor"] = cursor
+            r["dropped"] = 0
+            r["reads"] = 0
+            r["pid"] = os.getpid()
+            return r
+      finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+    raise RuntimeError("no free reader slot in %s" % self.path)
+
+  @property
+  def dropped(self):
+    return int(self._slot["dropped"])
+
+  def lag(self):
+    return int(self._ring.header["write_seq"]) - int(self._slot["cursor"])
+
+  def read(self, max_frames=None):
+    """Returns (t, CanColumns) views of the next frames, possibly empty.
+
+    Stops at the end of the ring, so a full backlog may take two reads.
+    """
+    slot = self._slot
+    write_seq = int(self._ring.header["write_seq"])
+    cursor = int(slot["cursor"])
+    if write_seq - cursor > self.capacity - self.slack:
+      # too slow, skip to where the writer won't catch us right away
+      skip = write_seq - (self.capacity - self.slack) - cursor
+      slot["dropped"] += skip
+      cursor += skip
+    end = write_seq
+    if max_frames is not None:
+      end = min(end, cursor + max_frames)
+    pos = cursor % self.capacity
+    end = min(end, cursor + self.capacity - pos)
+    rec = self._ring.frames[pos:pos + end - cursor]
+    slot["cursor"] = end
+    slot["reads"] += 1
+    self._last = cursor
+    return rec["t"], CanColumns(rec["address"], rec["bus_time"], rec["length"],
+                                rec["src"], rec["data"])
+
+  def intact(self):
+    """False if the writer has overwritten frames of the last read, or is
+    overwriting them right now."""
+    if self._last is None:
+      return True
+    header = self._ring.header
+    seq = max(int(header["write_seq"]), int(header["claim_seq"]))
+    return seq - self._last <= self.capacity
+
+  def recv(self, timeout=None, max_frames=None):
+    """Like read(), but waits up to timeout seconds for frames."""
+    end = None if timeout is None else monotonic() + timeout
+    while True:
+      t, cols = self.read(max_frames)
+      if len(t) or (end is not None and monotonic() >= end):
+        return t, cols
+      time.sleep(self.poll_interval)
+
+  def writer_alive(self):
+    pid = int(self._ring.header["writer_pid"])
+    return pid != 0 and _alive(pid)
+
+  def close(self):
+    if self._slot is not None:
+      self._slot["pid"] = 0
+      self._slot = None
+      self._ring.close()
+
+
+def _alive(pid):
+  try:
+    os.kill(pid, 0)
+  except OSError as e:
+    return e.errno == errno.EPERM
+  return True
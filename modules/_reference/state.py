@@ -0,0 +1,138 @@
+# latest value per (bus, address), fed from the receive path
+import threading
+
+import numpy as np
+
+from .clock import monotonic
+
+
+class CanStateTable(object):
+  """Last payload, bus time, host time and update count per (bus, address).
+
+  Storage is preallocated for `capacity` keys, a key is assigned a slot the
+  first time it is seen. Keys beyond capacity are ignored and counted in
+  `dropped_keys`. Reads and updates take a lock, so get() is safe from any
+  thread while the receive thread is updating.
+  """
+
+  def __init__(self, capacity=1024):
+    self.capacity = capacity
+    self._slots = {}
+    self._keys = []
+    self._lock = threading.Lock()
+
+    self.data = np.zeros((capacity, 8), dtype=np.uint8)
+    self.length = np.zeros(capacity, dtype=np.uint8)
+    self.bus_time = np.zeros(capacity, dtype=np.uint16)
+    self.host_time = np.zeros(capacity, dtype=np.float64)
+    self.count = np.zeros(capacity, dtype=np.uint32)
+    self.dropped_keys = 0
+
+  def __len__(self):
+    return len(self._keys)
+
+  def __contains__(self, key):
+    return key in self._slots
+
+  def _slot(self, bus, address):
+    # caller holds the lock
+    key = (bus, address)
+    slot = self._slots.get(key)
+    if slot is None:
+      if len(self._keys) >= self.capacity:
+        self.dropped_keys += 1
+        return None
+      slot = len(self._keys)
+      self._slots[key] = slot
+      self._keys.append(key)
+    return slot
+
+  def update(self, frames, t=None):
+    # frames as returned by can_recv
+    if t is None:
+      t = monotonic()
+    with self._lock:
+      for address, bus_time, dat, src in frames:
+        slot = self._slot(src, address)
+        if slot is None:
+          continue
+        n = len(dat)
+        self.data[slot, :n] = bytearray(dat)
+        self.length[slot] = n
+        self.bus_time[slot] = bus_time
+        self.host_time[slot] = t
+        self.count[slot] += 1
+
+  def update_batch(self, batch):
+    # CanFrameBatch, e.g. as a CanReceiver listener
+    t = batch.t if batch.t is not None else monotonic()
+    with self._lock:
+      for frame in batch.cursor():
+        address, bus_time, dat, src = frame
+        slot = self._slot(src, address)
+        if slot is None:
+          continue
+        n = len(dat)
+        self.data[slot, :n] = bytearray(dat)
+        self.length[slot] = n
+        self.bus_time[slot] = bus_time
+        self.host_time[slot] = t
+        self.count[slot] += 1
+
+  def update_columns(self, cols, t=None):
+    # CanColumns, vectorized: later frames of a key win
+    if len(cols) == 0:
+      return
+    if t is None:
+      t = monotonic()
+    keys = (cols.src.astype(np.uint64) << 32) | cols.address.astype(np.uint64)
+    uniq, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    # index of the last frame for each unique key
+    last = np.zeros(len(uniq), dtype=np.intp)
+    last[inverse] = np.arange(len(keys))
+    with self._lock:
+      slots = []
+      keep = []
+      for i, key in enumerate(uniq.tolist()):
+        slot = self._slot(key >> 32, key & 0xFFFFFFFF)
+        if slot is not None:
+          slots.append(slot)
+          keep.append(i)
+      if not slots:
+        return
+      slots = np.array(slots, dtype=np.intp)
+      src_idx = last[keep]
+      self.data[slots] = cols.data[src_idx]
+      self.length[slots] = cols.length[src_idx]
+      self.bus_time[slots] = cols.bus_time[src_idx]
+      self.host_time[slots] = t if np.isscalar(t) else np.asarray(t)[src_idx]
+      self.count[slots] += counts[keep].astype(np.uint32)
+
+  def get(self, bus, address):
+    """Returns (dat, bus_time, host_time, count) for the key, or None."""
+    with self._lock:
+      slot = self._slots.get((bus, address))
+      if slot is None:
+        return None
+      return (self.data[slot, :self.length[slot]].tobytes(), int(self.bus_time[slot]),
+              float(self.host_time[slot]), int(self.count[slot]))
+
+  def get_data(self, bus, address):
+    with self._lock:
+      slot = self._slots.get((bus, address))
+      if slot is None:
+        return None
+      return self.data[slot, :self.length[slot]].tobytes()
+
+  def snapshot(self):
+    """Copies of the whole table as arrays, one row per key in `keys`."""
+    with self._lock:
+      n = len(self._keys)
+      return {"keys": list(self._keys),
+              "bus": np.array([k[0] for k in self._keys], dtype=np.uint8),
+              "address": np.array([k[1] for k in self._keys], dtype=np.uint32),
+              "data": self.data[:n].copy(),
+              "length": self.length[:n].copy(),
+              "bus_time": self.bus_time[:n].copy(),
+              "host_time": self.host_time[:n].copy(),
+              "count": self.count[:n].copy()}
@@ -0,0 +1,181 @@
+# per bus CAN rate / load counters and USB error counts, updated on the hot path
+import threading
+
+import numpy as np
+
+from .clock import monotonic
+from .columnar import CAN_FRAME_HEADER, can_frames_view
+
+NUM_BUSES = 4 # CAN1-3 + GMLAN
+DEFAULT_SPEED_KBPS = 500
+
+# nominal bits on the wire (no stuffing), including interframe space
+STD_FRAME_BITS = 47
+EXT_FRAME_BITS = 67
+
+# below this many frames counting in a struct loop beats one bincount
+COUNT_MIN_FRAMES = 16
+
+USB_ERRORS = ("USBErrorIO", "USBErrorOverflow", "USBErrorPipe", "USBErrorTimeout",
+              "USBErrorNoDevice", "USBErrorNotFound", "USBErrorBusy", "USBErrorAccess",
+              "USBErrorInterrupted", "USBErrorOther")
+
+
+def _record_kinds(dat):
+  # (kind, count) pairs for a large bulk buffer, where kind is the low 12
+  # bits of f2 (length and src) shifted left once, plus the extended bit
+  recs = can_frames_view(dat)
+  kinds = ((recs["f2"] & 0xFFF) << 1) | ((recs["f1"] >> 2) & 1)
+  counts = np.bincount(kinds)
+  kinds = np.flatnonzero(counts)
+  return zip(kinds.tolist(), counts[kinds].tolist())
+
+
+class CanStats(object):
+  """Fixed size counters for CAN traffic through one Panda.
+
+  rx counts frames read over bulk endpoint 1 (tx echoes, src bit 0x80, are
+  counted separately in tx_echo), tx counts frames written by
+  can_send_many. Bus load is estimated from nominal frame bit lengths and
+  the speed passed to set_can_speed_kbps.
+
+  Frames are counted straight from the records, with a struct loop for
+  small buffers and one bincount over (bus, length, extended) for large
+  ones, so a read or write costs little more than decoding its headers.
+
+  Readers, senders and libusb completions record from different threads,
+  every update takes the lock.
+  """
+
+  def __init__(self):
+    self.speed_kbps = np.full(NUM_BUSES, DEFAULT_SPEED_KBPS, dtype=np.float64)
+    self._lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      self._reset()
+
+  def _reset(self):
+    # per bus lists of python ints, snapshot() hands out arrays
+    self.rx_frames = [0] * NUM_BUSES
+    self.rx_bytes = [0] * NUM_BUSES
+    self.rx_extended = [0] * NUM_BUSES
+    self.tx_frames = [0] * NUM_BUSES
+    self.tx_bytes = [0] * NUM_BUSES
+    self.tx_extended = [0] * NUM_BUSES
+    self.tx_echo = [0] * NUM_BUSES
+    self.unknown_bus = 0
+    self.reads = 0
+    self.empty_reads = 0
+    self.writes = 0
+    self.recv_retries = 0
+    self.send_retries = 0
+    self.control_retries = 0
+    self.usb_errors = dict((name, 0) for name in USB_ERRORS)
+
+  def set_speed(self, bus, speed_kbps):
+    if 0 <= bus < NUM_BUSES:
+      self.speed_kbps[bus] = speed_kbps
+
+  def record_error(self, e):
+    name = type(e).__name__
+    if name not in self.usb_errors:
+      name = "USBErrorOther"
+    with self._lock:
+      self.usb_errors[name] += 1
+
+  def record_retry(self, counter):
+    # counter names the field, e.g. "recv_retries", see RetryState
+    with self._lock:
+      setattr(self, counter, getattr(self, counter) + 1)
+
+  def _other_bus(self, bus, n, echo):
+    if echo is not None and bus & 0x80 and bus & 0x7F < NUM_BUSES:
+      echo[bus & 0x7F] += n
+    else:
+      self.unknown_bus += n
+
+  def _record(self, dat, frames, nbytes, extended, echo=None):
+    # caller holds the lock
+    n = len(dat) // 0x10
+    if n < COUNT_MIN_FRAMES:
+      unpack_from = CAN_FRAME_HEADER.unpack_from
+      for off in range(0, n * 0x10, 0x10):
+        f1, f2 = unpack_from(dat, off)
+        bus = (f2 >> 4) & 0xFF
+        if bus >= NUM_BUSES:
+          self._other_bus(bus, 1, echo)
+          continue
+        frames[bus] += 1
+        nbytes[bus] += min(f2 & 0xF, 8)
+        if f1 & 4:
+          extended[bus] += 1
+      return
+    for kind, n in _record_kinds(dat):
+      bus = kind >> 5
+      if bus >= NUM_BUSES:
+        self._other_bus(bus, n, echo)
+        continue
+      frames[bus] += n
+      nbytes[bus] += n * min((kind >> 1) & 0xF, 8)
+      if kind & 1:
+        extended[bus] += n
+
+  def record_rx(self, dat):
+    # raw bulk read buffer
+    with self._lock:
+      self.reads += 1
+      if len(dat) < 0x10:
+        self.empty_reads += 1
+        return
+      self._record(dat, self.rx_frames, self.rx_bytes, self.rx_extended, self.tx_echo)
+
+  def record_tx(self, dat):
+    # encoded bulk write buffer, as returned by CanEncoder
+    with self._lock:
+      self.writes += 1
+      self._record(dat, self.tx_frames, self.tx_bytes, self.tx_extended)
+
+  @staticmethod
+  def _bits(frames, nbytes, extended):
+    return (STD_FRAME_BITS * np.array(frames, dtype=np.uint64) +
+            (EXT_FRAME_BITS - STD_FRAME_BITS) * np.array(extended, dtype=np.uint64) +
+            8 * np.array(nbytes, dtype=np.uint64))
+
+  def snapshot(self, prev=None):
+    """Totals plus per bus rates since prev.
+
+    Args:
+      prev (dict): an earlier snapshot() of these stats. Every poller keeps
+        its own, so pollers don't disturb each other's rates.
+
+    Returns:
+      dict: rx/tx frames_per_s, bytes_per_s and bus_load (0..1) are arrays
+        indexed by bus and zero without prev, the rest are running totals.
+    """
+    u64 = lambda counts: np.array(counts, dtype=np.uint64)
+    with self._lock:
+      # copies taken together, the arrays are built outside the lock
+      now = monotonic()
+      rx = list(self.rx_frames), list(self.rx_bytes), list(self.rx_extended)
+      tx = list(self.tx_frames), list(self.tx_bytes), list(self.tx_extended)
+      ret = {"t": now, "tx_echo": list(self.tx_echo), "unknown_bus": self.unknown_bus,
+             "reads": self.reads, "empty_reads": self.empty_reads, "writes": self.writes,
+             "recv_retries": self.recv_retries, "send_retries": self.send_retries,
+             "control_retries": self.control_retries,
+             "usb_errors": dict(self.usb_errors), "speed_kbps": self.speed_kbps.copy()}
+    ret.update(rx_frames=u64(rx[0]), rx_bytes=u64(rx[1]), rx_bits=self._bits(*rx),
+               tx_frames=u64(tx[0]), tx_bytes=u64(tx[1]), tx_bits=self._bits(*tx),
+               tx_echo=u64(ret["tx_echo"]))
+    if prev is None or now <= prev["t"]:
+      zero = np.zeros(NUM_BUSES)
+      ret.update(rx_frames_per_s=zero, rx_bytes_per_s=zero, tx_frames_per_s=zero,
+                 tx_bytes_per_s=zero, bus_load=zero)
+      return ret
+    dt = now - prev["t"]
+    rate = lambda key: (ret[key].astype(np.float64) - prev[key]) / dt
+    ret.update(rx_frames_per_s=rate("rx_frames"), rx_bytes_per_s=rate("rx_bytes"),
+               tx_frames_per_s=rate("tx_frames"), tx_bytes_per_s=rate("tx_bytes"),
+               bus_load=(rate("rx_bits") + rate("tx_bits")) / (self.speed_kbps * 1000.))
+    return ret
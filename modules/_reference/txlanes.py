@@ -0,0 +1,155 @@
+# priority lanes on top of can_send_many, critical frames jump bulk traffic
+import collections
+import threading
+
+from .clock import monotonic
+
+HIGH = 0
+NORMAL = 1
+BULK = 2
+
+
+class TxLanes(object):
+  """Transmit lanes drained by one sender thread, lane 0 first.
+
+  Every bulk write takes all waiting frames of the highest lane (up to
+  max_transfer) and fills the rest from lower lanes. Writes are kept small
+  so a frame submitted to HIGH waits for at most the write in progress.
+
+    lanes = panda.enable_tx_lanes()
+    lanes.submit(replay_frames, BULK)
+    lanes.submit([[0x1d0, None, dat, 0]], HIGH)
+  """
+
+  def __init__(self, panda, n_lanes=3, max_transfer=0x40):
+    self.panda = panda
+    self.max_transfer = max_transfer
+    self._lanes = [collections.deque() for _ in range(n_lanes)]
+    self._cond = threading.Condition()
+    self._thread = None
+    self._running = False
+    self._busy = False
+
+    self.error = None
+    self.writes = 0
+    self.submitted = [0] * n_lanes
+    self.sent = [0] * n_lanes
+    self.dropped = [0] * n_lanes
+    self.max_latency = [0.0] * n_lanes
+
+  def submit(self, arr, lane=NORMAL):
+    t = monotonic()
+    with self._cond:
+      if self.error is not None:
+        # the sender is gone, nothing queued now would ever be written
+        raise self.error
+      q = self._lanes[lane]
+      for frame in arr:
+        q.append((frame, t))
+      self.submitted[lane] += len(arr)
+      self._cond.notify_all()
+
+  def pending(self):
+    with self._cond:
+      return [len(q) for q in self._lanes]
+
+  def _next_transfer(self):
+    # caller holds the lock
+    chunk = []
+    times = []
+    for lane, q in enumerate(self._lanes):
+      while q and len(chunk) < self.max_transfer:
+        frame, t = q.popleft()
+        chunk.append(frame)
+        times.append((lane, t))
+      if len(chunk) >= self.max_transfer:
+        break
+    return chunk, times
+
+  def _run(self):
+    try:
+      while True:
+        with self._cond:
+          while self._running and not any(self._lanes):
+            self._cond.wait()
+          if not self._running:
+            return
+          chunk, times = self._next_transfer()
+          self._busy = True
+        ok = False
+        try:
+          self.panda.can_send_many(chunk)
+          ok = True
+        finally:
+          now = monotonic()
+          with self._cond:
+            self._busy = False
+            self.writes += 1
+            for lane, t in times:
+              if ok:
+                self.sent[lane] += 1
+                self.max_latency[lane] = max(self.max_latency[lane], now - t)
+              else:
+                self.dropped[lane] += 1
+            self._cond.notify_all()
+    except Exception as e:
+      with self._cond:
+        self.error = e
+    finally:
+      with self._cond:
+        self._running = False
+        self._cond.notify_all()
+
+  def start(self):
+    if self._thread is None:
+      self._running = True
+      self._thread = threading.Thread(target=self._run, name="panda-can-tx-lanes")
+      self._thread.daemon = True
+      self._thread.start()
+    return self
+
+  def stop(self, drain=False, timeout=None):
+    """Stops the sender, returns the number of frames left unsent.
+
+    With drain, waits up to timeout seconds for the lanes to be written
+    first. Frames still queued after that are dropped and counted.
+    """
+    if drain and self._running:
+      try:
+        self.flush(timeout)
+      except Exception:
+        # the sender died, error has it and the lanes are dropped below
+        pass
+    with self._cond:
+      self._running = False
+      self._cond.notify_all()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+    with self._cond:
+      n = 0
+      for lane, q in enumerate(self._lanes):
+        self.dropped[lane] += len(q)
+        n += len(q)
+        q.clear()
+      return n
+
+  def flush(self, timeout=None):
+    """Waits until every lane is empty and written, returns False on timeout."""
+    end = None if timeout is None else monotonic() + timeout
+    with self._cond:
+      while (any(self._lanes) or self._busy) and self._running:
+        remaining = None if end is None else end - monotonic()
+        if remaining is not None and remaining <= 0:
+          return False
+        self._cond.wait(remaining)
+      if self.error is not None:
+        raise self.error
+      return not any(self._lanes)
+
+  def stats(self):
+    with self._cond:
+      return {"submitted": list(self.submitted), "sent": list(self.sent),
+              "pending": [len(q) for q in self._lanes], "dropped": list(self.dropped),
+              "writes": self.writes,
+              "max_latency": list(self.max_latency)}